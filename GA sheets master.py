@@ -10,10 +10,6 @@ import random
 import sys
 import time
 import datetime
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 
 
 #I use my implementation of Markov Network Brains (https://github.com/nicholasharris/Markov-Brains-Python)
@@ -21,231 +17,264 @@ from google.auth.transport.requests import Request
 #  so long as the chromosomes of the population can be written to Google Sheet cells
 import markov
 
+#The coordination backends (Google Sheets, or a local SQLite file when every process is on one host)
+import transport
 
-#A constant to store the sheet ID that you want to work with.
-# Check out https://developers.google.com/sheets/api/quickstart/python for info on using Google Sheets API
-GENOME_SHEET_ID = 'your_sheet_ID_here'
+#Remembers the fitness of every genome already evaluated, so carried-over elites aren't evaluated again
+import fitness_cache
 
+#Retries failed API requests and keeps this process within its share of the API quota
+import api_client
 
-#Ths number is arbitrary; set whatever criteria you wish
-NUM_GENS = 5000
+#Authenticates and builds the Google Sheets API service (the Google libraries are only loaded for the Sheets backend)
+import sheets_client
 
+#Exchanges the best genomes with the other islands in island mode
+import migration
+
+#Saves the population regularly, so a stopped run can be resumed
+import checkpoint
 
-#This function sends out the chromosomes to your designated Google sheet,
-#   waits for the slave processes to finish evaluating the chromsomes (assign a fitness),
-#   then performs the GA operations to create a new generation so the cycle can repeat
-def Eval_Genomes(myPopulation, maxGens):
 
-    gen = 0
+#A constant to store the sheet ID that you want to work with.
+# Check out https://developers.google.com/sheets/api/quickstart/python for info on using Google Sheets API
+GENOME_SHEET_ID = 'your_sheet_ID_here'
 
-    result = []
+#Which coordination backend to use: 'sheets' for the shared Google Sheet, or 'local' to run
+#  the master and slaves on one computer through the SQLite file at LOCAL_DB_PATH, or 'shm' to
+#  share the population through shared memory blocks named after SHM_NAME (also one computer only).
+#  Master and slaves must all use the same backend.
+BACKEND = 'sheets'
+LOCAL_DB_PATH = 'genomes.db'
+SHM_NAME = 'distributed_ga'
 
-    # Do the authentication here as well just in case
+#How many processes (the master plus every slave) share the Google Sheets API quota. Each one
+#  paces its requests to its share, so together they don't get rejected for going over it.
+API_WORKERS = 5
 
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+#To spread a large population over several spreadsheets or tabs, list them here as (sheet ID, tab name)
+#  pairs, with None as the tab name for a spreadsheet's first tab; GENOME_SHEET_ID is then not used.
+#  Every shard holds a share of each generation, and they are all read and written in parallel.
+#  Master and slaves must list the same shards, in the same order.
+GENOME_SHARDS = []
 
-    service = build('sheets', 'v4', credentials=creds)
+#Extra connections the master uploads and downloads large transfers on, TRANSFER_CONNECTIONS requests
+#  at the same time (per shard). A publication is only split into several requests when it is larger
+#  than one request can carry (TRANSFER_CHARACTERS), and a read of the results when it has more than
+#  TRANSFER_CHUNK rows, since every request counts against the quota. 0 sends everything over the main connection.
+TRANSFER_CONNECTIONS = 4
+TRANSFER_CHUNK = 10000
+TRANSFER_CHARACTERS = 2000000
 
-    # Call the Sheets API
-    sheet = service.spreadsheets()
 
+#Describes how the slaves evaluate genomes; cached fitnesses are only reused under the same value.
+#  Must match EVAL_CONFIG in the slave process; change it whenever you change the problem domain.
+EVAL_CONFIG = ('markov demo', 16, 1)
 
+#File the fitness cache is kept in between runs (None to keep it in memory only)
+FITNESS_CACHE_PATH = 'fitness_cache.pkl'
 
-    #Here is the main GA loop, that repeats for a set number of generations
-    while gen < maxGens:
-        #Master Process, write all genomes to sheet
-        print("Clearing sheet.")
-
-        start = time.time()
-        #Clear Genomes Sheet
-        # Call the Sheets API
-        sheet = service.spreadsheets()
-
-        range_ = 'A1:G50000'  # clears the sheet up to a very high value of 50,000 columns. You may reduce this if you wish.
-
-        clear_values_request_body = {
-           
-        }
-
-        # You will find many of these try/except statements; they assure the entire process doesn't grind to a halt due to a temporary lost
-        # connection, but allows recovery. You may be able to improve efficiency in waiting times through experimentation.
-        try:
-            request = service.spreadsheets().values().clear(spreadsheetId=GENOME_SHEET_ID, range=range_, body=clear_values_request_body)
-            response = request.execute()
-        except:
-            print("I encountered an error.")
-            time.sleep(30)
-            continue
+#The population is checkpointed to CHECKPOINT_PATH every CHECKPOINT_INTERVAL generations (None to turn
+#  checkpoints off). On start the master resumes from the checkpoint if there is one, and picks up the
+#  generation still on the sheet if it is the one that was checkpointed. Delete the checkpoint files
+#  (CHECKPOINT_PATH and CHECKPOINT_PATH.genomes.*) to start a new run.
+CHECKPOINT_PATH = 'checkpoint.bin'
+CHECKPOINT_INTERVAL = 1
 
-        end = time.time()
-        print("Sheet cleared. Time elapsed: " + str(end - start) )
 
-        
+#Ths number is arbitrary; set whatever criteria you wish
+NUM_GENS = 5000
 
-        print("Collecting Genomes.")
 
-        start = time.time()
-        # Write all genomes to the Google sheet. I obtain the genomes as defined in my implemenation of Markov Network Brains.
-        #   Any chromosome will do, just convert it into a string and separate values with a comma, as I do below.
-        range_ = 'G1:G50000'
-        values = []
-        for x in range(len(myPopulation.brains)):
-            myList = []
-            myStr = ""
-            
-            for y in range(len(myPopulation.brains[x].genome.sequence)):
-                myStr = myStr + str(myPopulation.brains[x].genome.sequence[y]) + ","
+#Once only this fraction of a generation is left to evaluate, the random individuals of the next
+#  generation (which don't depend on this one's fitnesses) are handed out too, so slaves that run
+#  out of work evaluate them instead of waiting for the slowest genomes of the generation.
+PREFETCH_FRACTION = 0.2
 
-            myList.append(myStr)
-            values.append(myList)
-        end = time.time()
-        print("Time elapsed: " + str(end - start))  #I calculate the time for different phases of the API communication (writing genomes is the longest)
+#The next generation is published this many genomes at a time while it is bred, so slaves can start
+#  on the first children before the last ones exist. Every chunk costs a write request: None sizes the
+#  chunks so a generation goes out without waiting on this process's share of the quota (API_WORKERS).
+PUBLISH_CHUNK = None
 
-        print("Writing to sheet")
 
-        start = time.time()
+#Set STEADY_STATE to True to evolve without generations: the master keeps STEADY_STATE_WINDOW genomes
+#  out for evaluation and breeds a replacement as soon as any of them comes back, so no genome waits
+#  for the slowest one of its generation (see MarkovPopulation.ask and tell).
+STEADY_STATE = False
+STEADY_STATE_WINDOW = 100
 
-        body = {
-            'values': values
-        }
+#In steady-state mode genomes keep being added to the published generation; once it has this many
+#  rows, the genomes still out are published again as a new, small generation.
+STEADY_STATE_ROWS = 2000
 
-        try:
-            result = service.spreadsheets().values().update(spreadsheetId=GENOME_SHEET_ID,range=range_,valueInputOption='RAW', body=body).execute()
-        except:
-            print("I encountered an error.")
-            time.sleep(30)
-            continue
-        print('{0} cells updated.'.format(result.get('updatedCells')))
-        end = time.time()
-        print("Time elapsed: " + str(end - start) )  # I found transfering the data on a very large population could take almost a minute,
-                                                     #    a little long but on many problem domains this time will be dwarfed by the time needed to evalute all the chromosomes
-        
-        doneFlag = False
-        fitnesses = []
-        val_fitnesses = []
-        while doneFlag == False:
-            #wait until all genomes have been evaluated, then calculate the next generation
-            fitness_range = 'E1:E50000'
-            result = []
-            try:
-                result = service.spreadsheets().values().get(
-                    spreadsheetId=GENOME_SHEET_ID, range=fitness_range).execute()
-            except:
-                print("I encountered an error.")
-                time.sleep(30)
-                continue
-            if result.get('values') is None:
-                time.sleep(10)
-                #print("empty")
-                continue
-            
-            numRows = result.get('values') if result.get('values')is not None else 0
-
-            #If all fitnesses have been assigned, exit loop to calculate next generation
-            fullFlag = True
-
-            #we wait until we've received enough fitnesses to match the size of our population
-            if len(numRows) < len(myPopulation.brains):  
-                fullFlag = False
-            for x in range(len(numRows)):
-                if (numRows[x] is None):
-                    fullFlag = False
-                    break
-                elif (len(numRows[x]) == 0):
-                    fullFlag = False
-                    break
-                elif any(char.isdigit() for char in numRows[x][0]) == False:
-                    fullFlag = False
-                    break
-            if (fullFlag == True):  
-                fitness_range = 'F1:F50000'
-                try:
-                    result = service.spreadsheets().values().get(
-                    spreadsheetId=GENOME_SHEET_ID, range=fitness_range).execute()
-                except:
-                    print("I encountered an error.")
-                    time.sleep(30)
-                    continue
-                fitnesses = result.get('values')
-                val_range = 'E1:E50000'
-                try:
-                    result = service.spreadsheets().values().get(
-                    spreadsheetId=GENOME_SHEET_ID, range=val_range).execute()
-                except:
-                    print("I encountered an error.")
-                    time.sleep(30)
-                    continue
-                val_fitnesses = result.get('values')
-
-                doneFlag = True    
-            else:
-                #print(len(numRows))
-                time.sleep(10)
-        
-        # After all fitnesses were recorded to the sheet by slave processes, 
-        # assign all reported fitnesses to population of brains
-        for x in range(len(myPopulation.brains)):
-            myPopulation.brains[x].fitness = float(fitnesses[x][0])
-            myPopulation.brains[x].validation_fitness = float(val_fitnesses[x][0])
-        
-        
-        gen = gen + 1
+#Island model: run several masters, each with its own population, slaves and sheet (or LOCAL_DB_PATH
+#  or SHM_NAME), numbered 0 to ISLANDS - 1 in ISLAND. Every MIGRATION_INTERVAL generations each island
+#  sends copies of its MIGRANTS best genomes to the others and takes in theirs, through files in
+#  MIGRATION_PATH (MIGRATION_BACKEND = 'directory', e.g. on a shared drive) or through a block of cells
+#  of MIGRATION_SHEET_ID (MIGRATION_BACKEND = 'sheets'). MIGRATION_BACKEND = None runs a single population.
+MIGRATION_BACKEND = None
+ISLAND = 0
+ISLANDS = 1
+MIGRATION_INTERVAL = 10
+MIGRANTS = 5
+MIGRATION_PATH = 'migration'
+MIGRATION_SHEET_ID = 'your_sheet_ID_here'
 
-        #Clear the sheet for use in the next generation of the GA
-        print("Clearing sheet.")
 
-        start = time.time()
-        #Clear Genomes Sheet
-        # Call the Sheets API
-        sheet = service.spreadsheets()
+#Send this island's best genomes to the other islands and take in theirs
+def Migrate(myPopulation, myChannel, myCache):
+    global MIGRANTS
 
-        range_ = 'G1:G50000'  
+    myChannel.emigrate(myPopulation.migrants(MIGRANTS))
+    arrivals = myChannel.immigrants()
+    for genome, fitness, validation_fitness in arrivals:
+        myCache.put(genome.content_hash(), fitness, validation_fitness)
+    myPopulation.immigrate(arrivals)
+    print(str(len(arrivals)) + " migrants arrived.")
 
-        clear_values_request_body = {
-            
-        }
 
-        request = service.spreadsheets().values().clear(spreadsheetId=GENOME_SHEET_ID, range=range_, body=clear_values_request_body)
+#This function sends out the chromosomes through the transport (your designated Google sheet by default),
+#   waits for the slave processes to finish evaluating the chromsomes (assign a fitness),
+#   then performs the GA operations to create a new generation so the cycle can repeat
+def Eval_Genomes(myPopulation, maxGens, myTransport, myCache, myChannel = None, myCheckpoint = None):
+    global PREFETCH_FRACTION, PUBLISH_CHUNK, MIGRATION_INTERVAL, CHECKPOINT_INTERVAL
+
+    gen = myPopulation.gen   #0, unless resumed from a checkpoint
+
+    #Master Process, write all genomes of the first generation for the slaves.
+    #   The transport encodes each chromosome (see Genome.encode in markov.py); a different GA only
+    #   needs to give its chromosomes the same encode/decode methods.
+    #   Genomes already in the fitness cache (elites, duplicates) are marked done instead of re-evaluated.
+    #   After a restart, the generation still published is taken over as it is if it's this one.
+    print("Writing genomes.")
+    start = time.time()
+    published = list(myPopulation.brains)   #the brains of the generation, in the order they were published
+    if not myTransport.rejoin([brain.genome for brain in published]):
+        stream = transport.PopulationStream(myTransport, myCache, PUBLISH_CHUNK, myPopulation.popSize)
+        for brain in published:
+            stream.add(brain.genome)
+        stream.flush()
+        if myCheckpoint is not None and gen == 0:
+            myCheckpoint.save(myPopulation, published)
+    end = time.time()
+    print("Time elapsed: " + str(end - start) )  # I found transfering the data on a very large population could take almost a minute,
+                                                 #    a little long but on many problem domains this time will be dwarfed by the time needed to evalute all the chromosomes
+
+    #Here is the main GA loop, that repeats for a set number of generations
+    while gen < maxGens:
+        popSize = len(published)
 
+        #Near the end of the generation, hand out the next generation's random individuals
+        prefetched = []
+        def prefetch(done):
+            if len(prefetched) == 0 and myPopulation.diversity_generate > 0 and popSize - done <= PREFETCH_FRACTION * popSize:
+                randoms = myPopulation.random_brains(myPopulation.diversity_generate)
+                rows = myTransport.extend_population([brain.genome for brain in randoms])
+                prefetched.append((randoms, rows))
 
-        doneFlag = False
-        while doneFlag == False:
-            try:
-                response = request.execute()
-                doneFlag = True
-            except:
-                print("I encountered an error.")
-                doneFlag = False
-                time.sleep(30)
-            
+        #wait until all genomes have been evaluated, then calculate the next generation
+        fitnesses, val_fitnesses = myTransport.await_completion(popSize, prefetch)
 
-        end = time.time()
-        print("Sheet cleared. Time elapsed: " + str(end - start) )
+        # After all fitnesses were recorded by slave processes,
+        # assign all reported fitnesses to population of brains
+        for x in range(popSize):
+            published[x].fitness = float(fitnesses[x])
+            published[x].validation_fitness = float(val_fitnesses[x])
+            myCache.put(published[x].genome.content_hash(), published[x].fitness, published[x].validation_fitness)
+
+        #Random individuals evaluated ahead of time go into the cache, so the next generation has them as known
+        randoms = None
+        for randoms, rows in prefetched:
+            for brain, result in zip(randoms, myTransport.read_results(rows)):
+                if result is not None:
+                    myCache.put(brain.genome.content_hash(), float(result[0]), float(result[1]))
+        myCache.save()
+
+        if myChannel is not None and (gen + 1) % MIGRATION_INTERVAL == 0:
+            Migrate(myPopulation, myChannel, myCache)
+
+        gen = gen + 1
 
+        #Nothing needs clearing: publishing the next generation under a new epoch makes
+        #  everything left from this one stale.
 
         # Now perform the traditional Genetic Algorithm functions (crossover, mutation, selection) to create the next generation, and repeat.
         # All this is implemented in "markov.py", my python implmentation of Markov Network Brains.
         # Your own function(s) may go here to replace this one.
-        myPopulation.eval_genomes()
+        #   Each brain of the new generation is published as soon as it is created.
+        if gen < maxGens:
+            published = []
+            stream = transport.PopulationStream(myTransport, myCache, PUBLISH_CHUNK, myPopulation.popSize)
+            def publish(brain):
+                published.append(brain)
+                stream.add(brain.genome)
+            myPopulation.eval_genomes(randoms, publish)
+            stream.flush()
+            if myCheckpoint is not None and gen % CHECKPOINT_INTERVAL == 0:
+                myCheckpoint.save(myPopulation, published)
+        else:
+            myPopulation.eval_genomes()
+
+
+
+#Steady-state counterpart of Eval_Genomes: runs until maxEvaluations genomes have been evaluated
+def Eval_Steady_State(myPopulation, maxEvaluations, myTransport, myCache, myChannel = None, myCheckpoint = None):
+    global STEADY_STATE_WINDOW, STEADY_STATE_ROWS, MIGRATION_INTERVAL, CHECKPOINT_INTERVAL
+
+    evaluations = myPopulation.told   #0, unless resumed from a checkpoint
+    inFlight = {}   #row of the published generation -> brain being evaluated there
+
+    #Publish brains as a new generation or at the end of the current one; returns the number of rows added
+    def publish(brains, newGeneration):
+        genomes = [brain.genome for brain in brains]
+        known = [myCache.get(genome.content_hash()) for genome in genomes]   #known genomes come back right away
+        if newGeneration:
+            myTransport.publish_population(genomes, known)
+            rows = list(range(len(genomes)))
+        else:
+            rows = myTransport.extend_population(genomes, known)
+        inFlight.update(zip(rows, brains))
+        return len(rows)
+
+    #After a restart, the brains that were out for evaluation are handed out again first
+    print("Writing genomes.")
+    brains = list(myPopulation.asked.values())
+    published = publish(brains + [myPopulation.ask() for x in range(STEADY_STATE_WINDOW - len(brains))], True)
+
+    while evaluations < maxEvaluations:
+        #Collect whatever results came in since the last poll
+        rows = sorted(inFlight)
+        done = 0
+        for row, result in zip(rows, myTransport.read_results(rows)):
+            if result is not None:
+                brain = inFlight.pop(row)
+                myPopulation.tell(brain.ID, float(result[0]), float(result[1]))
+                myCache.put(brain.genome.content_hash(), float(result[0]), float(result[1]))
+                done = done + 1
+                if (evaluations + done) % myPopulation.popSize == 0:
+                    myCache.save()
+                if myCheckpoint is not None and (evaluations + done) % (CHECKPOINT_INTERVAL * myPopulation.popSize) == 0:
+                    myCheckpoint.save(myPopulation)
+                if myChannel is not None and (evaluations + done) % (MIGRATION_INTERVAL * myPopulation.popSize) == 0:
+                    Migrate(myPopulation, myChannel, myCache)
+        evaluations = evaluations + done
+        if done == 0:
+            myTransport.polling.wait()
+            continue
+        myTransport.polling.reset()
+
+        #Replace every genome that came back, so the slaves never run out of work
+        brains = [myPopulation.ask() for x in range(done)]
+        if published + len(brains) > STEADY_STATE_ROWS:
+            #Start over with a new generation; the genomes still out are handed out again
+            brains = [inFlight[row] for row in sorted(inFlight)] + brains
+            inFlight.clear()
+            published = publish(brains, True)
+        else:
+            published = published + publish(brains, False)
+    myCache.save()
+
 
-        
 
 ########### "Main" content ##########################################################
 random.seed()
@@ -257,33 +286,43 @@ random.seed()
 #   (Most "normal" chromosomes should be no issue).
 myPopulation = markov.MarkovPopulation(500, 64, 5000, 1, 30, 70, 0.001, 0.001, 0.001, 0.001, 0.001, 0.001, 0, True, True)
 
-# Make sure to visit https://developers.google.com/sheets/api/quickstart/python
-#    and complete all first-time authentication so that you can use the API code that follows
-
-creds = None
-# The file token.pickle stores the user's access and refresh tokens, and is
-# created automatically when the authorization flow completes for the first
-# time.
-if os.path.exists('token.pickle'):
-    with open('token.pickle', 'rb') as token:
-        creds = pickle.load(token)
-# If there are no (valid) credentials available, let the user log in.
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            'credentials.json', SCOPES)
-        creds = flow.run_local_server()
-    # Save the credentials for the next run
-    with open('token.pickle', 'wb') as token:
-        pickle.dump(creds, token)
-
-service = build('sheets', 'v4', credentials=creds)
+myCheckpoint = None
+if CHECKPOINT_PATH is not None:
+    myCheckpoint = checkpoint.Checkpoint(CHECKPOINT_PATH)
+    if myCheckpoint.load(myPopulation):
+        print("Resumed from the checkpoint of generation " + str(myPopulation.gen) + ".")
+
+myCache = fitness_cache.FitnessCache(fitness_cache.config_fingerprint(*EVAL_CONFIG), path = FITNESS_CACHE_PATH)
+
+if BACKEND == 'local':
+    myTransport = transport.LocalTransport(LOCAL_DB_PATH)
+elif BACKEND == 'shm':
+    myTransport = transport.SharedMemoryTransport(SHM_NAME)
+elif len(GENOME_SHARDS) > 0:
+    #One service per shard, as the shards are read and written from threads of their own
+    myClient = api_client.ApiClient(workers = API_WORKERS)
+    myTransport = transport.ShardedTransport([transport.SheetsTransport(sheets_client.build_service(), sheetID, client = myClient, tab = tab,
+                                                                        transferServices = [sheets_client.build_service() for x in range(TRANSFER_CONNECTIONS)],
+                                                                        chunkRows = TRANSFER_CHUNK, requestCharacters = TRANSFER_CHARACTERS)
+                                              for sheetID, tab in GENOME_SHARDS])
+else:
+    # Make sure to visit https://developers.google.com/sheets/api/quickstart/python
+    #    and complete all first-time authentication so that you can use the API code that follows
+    myTransport = transport.SheetsTransport(sheets_client.get_service(), GENOME_SHEET_ID, client = api_client.ApiClient(workers = API_WORKERS),
+                                            transferServices = [sheets_client.build_service() for x in range(TRANSFER_CONNECTIONS)], chunkRows = TRANSFER_CHUNK,
+                                            requestCharacters = TRANSFER_CHARACTERS)
+
+myChannel = None
+if MIGRATION_BACKEND == 'directory':
+    myChannel = migration.DirectoryChannel(MIGRATION_PATH, ISLAND)
+elif MIGRATION_BACKEND == 'sheets':
+    myChannel = migration.SheetsChannel(sheets_client.get_service(), MIGRATION_SHEET_ID, ISLAND, ISLANDS, api_client.ApiClient(workers = API_WORKERS), MIGRANTS)
 
 
 # Run the gentic algorithm for an arbitrary number of generations, or set your own stopping point based on your own criteria
 print("Running Eval Genomes Loop")
-Eval_Genomes(myPopulation, NUM_GENS)
-
-
+if STEADY_STATE:
+    Eval_Steady_State(myPopulation, NUM_GENS * myPopulation.popSize, myTransport, myCache, myChannel, myCheckpoint)
+else:
+    Eval_Genomes(myPopulation, NUM_GENS, myTransport, myCache, myChannel, myCheckpoint)
+myTransport.close()
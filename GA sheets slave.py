@@ -9,265 +9,202 @@ import os
 import random
 import sys
 import time
-import pickle
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import concurrent.futures
 
 #I use my implementation of Markov Network Brains (https://github.com/nicholasharris/Markov-Brains-Python)
 #  to test the larger distributed GA template, and for the purpose of demonstration. Any kind of GA can be used
 #  so long as the chromosomes of the population can be written to Google Sheet cells
 import markov
 
+#The coordination backends (Google Sheets, or a local SQLite file when every process is on one host)
+import transport
+
+#Remembers the fitness of every genome already evaluated, so duplicates aren't evaluated again
+import fitness_cache
+
+#Backoff between polls while there is nothing to claim
+import polling
+
+#Retries failed API requests and keeps this process within its share of the API quota
+import api_client
+
+#Authenticates and builds the Google Sheets API service (the Google libraries are only loaded for the Sheets backend)
+import sheets_client
+
 #A constant to store the sheet ID that you want to work with.
 # Check out https://developers.google.com/sheets/api/quickstart/python for info on using Google Sheets API
 GENOME_SHEET_ID = 'your_sheet_ID_here'
 
-#A constant to determine the number of chromsomes that this slave process should
-#  handle at once. This may be modified to suit your purposes.
-NUM_CLAIMS = 100
-      
-def Eval_Genomes():
-    global NUM_CLAIMS
+#Which coordination backend to use: 'sheets' for the shared Google Sheet, or 'local' to run
+#  the master and slaves on one computer through the SQLite file at LOCAL_DB_PATH, or 'shm' to
+#  share the population through shared memory blocks named after SHM_NAME (also one computer only).
+#  Master and slaves must all use the same backend.
+BACKEND = 'sheets'
+LOCAL_DB_PATH = 'genomes.db'
+SHM_NAME = 'distributed_ga'
 
-    START_INDEX = int(sys.argv[1]) #starting index on the sheet passed in via the command line (see the READ ME for details).
+#How many processes (the master plus every slave) share the Google Sheets API quota. Each one
+#  paces its requests to its share, so together they don't get rejected for going over it.
+API_WORKERS = 5
 
+#To spread a large population over several spreadsheets or tabs, list them here as (sheet ID, tab name)
+#  pairs, with None as the tab name for a spreadsheet's first tab; GENOME_SHEET_ID is then not used.
+#  Every shard holds a share of each generation, and they are all read and written in parallel.
+#  Master and slaves must list the same shards, in the same order.
+GENOME_SHARDS = []
 
-    #Go through the sheets authentication process in case you haven't already
+#This slave claims genomes from shard SHARD first (e.g. give each computer a different one), and then
+#  from the other shards once that one is drained, unless SHARD_STEAL is False.
+SHARD = 0
+SHARD_STEAL = True
 
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+#Describes how this process evaluates genomes; cached fitnesses are only reused under the same value.
+#  Must match EVAL_CONFIG in the master process; change it whenever you change the problem domain.
+EVAL_CONFIG = ('markov demo', 16, 1)
 
-    service = build('sheets', 'v4', credentials=creds)
+#The master's fitness cache file, read at startup if present (this process never writes it)
+FITNESS_CACHE_PATH = 'fitness_cache.pkl'
 
-    # Call the Sheets API
-    sheet = service.spreadsheets()
+#A constant to determine the number of chromsomes that this slave process should
+#  claim at once. Slaves keep claiming batches until the population is drained, so smaller
+#  batches spread the work more evenly between fast and slow machines, at the cost of more API calls.
+#  On Google Sheets this is the smallest claim: claims are sized from the population so that each of
+#  the NUM_SLAVES slaves takes about CLAIMS_PER_SLAVE of them per generation, as every claim costs
+#  three requests against the quota the processes share.
+NUM_CLAIMS = 10
+NUM_SLAVES = API_WORKERS - 1
+CLAIMS_PER_SLAVE = 4
+
+#How many worker processes evaluate genomes in parallel. With more than one, this slave fans
+#  the genomes of its claims out to a pool of processes and keeps a few claims in flight, so
+#  one slave per computer keeps every core busy. 1 evaluates everything in this process.
+NUM_WORKERS = os.cpu_count() or 1
+
+#How often (in seconds) the pool loop wakes up to renew its claims while genomes are evaluating
+HEARTBEAT_INTERVAL = 5
+
+
+#Evaluate one genome and return its (fitness, validation fitness). With NUM_WORKERS > 1 this runs
+#  in the worker processes, so it must only depend on its argument and the module-level constants.
+def Evaluate_Genome(genome):
+    #Put the genome into the markov brain object according to its structure.
+    # The way you construct phenotype from genotype is dependant on the specifics of your GA.
+    brain = markov.MarkovBrain(16, genome.length, 1, 0, genome)
+    #If your evaluation activates the brain more than a hundred times or so, brain.compile() first makes
+    #  every activation several times faster, with the same results (see brain_benchmark.py).
+
+    #Now that you have constructed the phenotype, evaluate the brain according to whatever
+    #  problem domain you are working with. This can range from very simple to very complex
+    #  and is entirely up to you. Here I return an arbitrary fitness for the purpose of demonstration.
+    #      I also include room for a "validation fitness", or more generally
+    #       you may just think of it as a secondary notion of fitness if you have need for it.
+    brain.fitness = 100.0 #arbitrary
+    brain.validation_fitness = 100.0 #arbitrary
+    return brain.fitness, brain.validation_fitness
+
+
+#The genomes of one claim, with the fitnesses found so far (None until evaluated)
+class ClaimWork:
+    def __init__(self, claim, genomes, myCache):
+        self.claim = claim
+        self.genomes = genomes
+        self.keys = [genome.content_hash() for genome in genomes]
+        self.fitnesses = [None] * len(genomes)
+        self.val_fitnesses = [None] * len(genomes)
+        self.todo = []
+        for x in range(len(genomes)):
+            known = myCache.get(self.keys[x])   #genome already evaluated before, no need to build or run it
+            if known is not None:
+                self.fitnesses[x], self.val_fitnesses[x] = known
+            else:
+                self.todo.append(x)
 
-    claim_range = ""
+    def record(self, x, fitness, val_fitness, myCache):
+        self.fitnesses[x] = fitness
+        self.val_fitnesses[x] = val_fitness
+        myCache.put(self.keys[x], fitness, val_fitness)
 
+    def finished(self):
+        return all(fitness is not None for fitness in self.fitnesses)
 
-    #This slave process will repeat the cycle of waiting for new chromosomes and evaluating them, forever.
-    while True: 
-        brains = []
-        result = []
-        nets = []
 
-        endTrainFlag = False
+def Eval_Genomes(myTransport, myCache):
+    global NUM_CLAIMS
+
+    #Poll quickly right after a batch, then back off (up to 30 seconds) while nothing is published
+    myPolling = polling.PollingPolicy(1, 30)
 
-        #Slave process; find genomes in sheet for me to use
+    #This slave process will repeat the cycle of waiting for new chromosomes and evaluating them, forever.
+    while True: 
+        #Slave process; find genomes for me to use
         print("Collecting Genomes.")
 
-        doneFlag = False
-        numGenomes = 0
-        while doneFlag == False:
-            #Check that genomes are present in the sheet
-            genome_range = 'G1:G50000'
-            try:
-                result = service.spreadsheets().values().get(
-                spreadsheetId=GENOME_SHEET_ID, range=genome_range).execute()
-            except:
-                print("I encountered an error.")
-                time.sleep(30)
-                continue
-            if result.get('values') is None:
-                time.sleep(18)
-                #print("empty")
+        batch = myTransport.claim_batch(NUM_CLAIMS)
+        if batch is None:   # no genomes yet, or all genomes are claimed, wait patiently
+            myPolling.wait()
+            continue
+        myPolling.reset()
+        work = ClaimWork(batch[0], batch[1], myCache)
+
+        #Call heartbeat regularly while evaluating so the claim isn't given to another slave;
+        #  it only talks to the sheet once a third of the lease time has passed.
+        for x in work.todo:
+            fitness, val_fitness = Evaluate_Genome(work.genomes[x])
+            work.record(x, fitness, val_fitness, myCache)
+            myTransport.heartbeat(work.claim)
+
+        #write fitness values back for the master
+        myTransport.submit_fitness(work.claim, work.fitnesses, work.val_fitnesses)
+
+
+#Same cycle as Eval_Genomes, but the genomes are evaluated by a pool of worker processes. This
+#  process alone talks to the sheet: it claims enough batches to keep every worker busy (plus
+#  one batch of slack), and writes back the fitnesses of each claim as soon as its last genome is done.
+def Eval_Genomes_Pool(myTransport, myCache, myPool):
+    global NUM_CLAIMS, NUM_WORKERS, HEARTBEAT_INTERVAL
+
+    myPolling = polling.PollingPolicy(1, 30)
+    nextClaimAt = 0        #when to try claiming again after finding nothing to claim
+    pending = {}           #future -> (ClaimWork, index of the genome in the claim)
+    works = []             #claims in flight
+
+    while True:
+        #Top up the pool
+        while len(pending) < NUM_WORKERS + NUM_CLAIMS and time.time() >= nextClaimAt:
+            print("Collecting Genomes.")
+            batch = myTransport.claim_batch(NUM_CLAIMS)
+            if batch is None:   # no genomes yet, or all genomes are claimed
+                nextClaimAt = time.time() + myPolling.next_delay()
+                break
+            myPolling.reset()
+            work = ClaimWork(batch[0], batch[1], myCache)
+            if work.finished():   #everything was cached
+                myTransport.submit_fitness(work.claim, work.fitnesses, work.val_fitnesses)
                 continue
-            else:
-                numGenomes = result.get('values')
-                numGenomes = len(numGenomes)
-                doneFlag = True
-
-        doneFlag = False
-        while doneFlag == False:
-
-            numGenomes = 0
-            while doneFlag == False:
-                #Check that genomes are present in the sheet
-                genome_range = 'G1:G50000'
-                try:
-                    result = service.spreadsheets().values().get(
-                        spreadsheetId=GENOME_SHEET_ID, range=genome_range).execute()
-                except:   
-                    print("I encountered an error.")
-                    time.sleep(30)
-                    continue
-                if result.get('values') is None:
-                    time.sleep(18)
-                    #print("empty")
-                    continue
-                else:
-                    numGenomes = result.get('values')
-                    numGenomes = len(numGenomes)
-                    doneFlag = True
-            doneFlag = False
-            #Read Flag range to find available genomes
-            flag_range = "D" + str(START_INDEX) + ":D" + str(START_INDEX + NUM_CLAIMS - 1)
-            values = []
-            try:
-                result = service.spreadsheets().values().get(
-                    spreadsheetId=GENOME_SHEET_ID, range=flag_range).execute()
-            except:
-                print("I encountered an error.")
-                time.sleep(30)
-                continue
-            numClaimed = result.get('values') if result.get('values')is not None else 0
-            #if result.get('values') is not None:
-            #    numClaimed = len(numClaimed)
-            if result.get('values') is None:  #No claimed genomes
-                #Claim number of genomes immediately
-                claims = []
-                for x in range(NUM_CLAIMS):
-                    claims.append( ["CLAIMED"] )
-                claim_range = "D" + str(START_INDEX) + ":D" + str(START_INDEX + NUM_CLAIMS - 1)
-
-                body = {
-                    'values': claims
-                    }
-
-                try:
-                    result = service.spreadsheets().values().update(spreadsheetId=GENOME_SHEET_ID,range=claim_range,valueInputOption='RAW', body=body).execute()
-                except:
-                    print("I encountered an error.")
-                    time.sleep(30)
-                    continue
-            
-    
-                #Read the genomes we have claimed from the sheet
-                
-                genome_range = "G" + str(START_INDEX) + ":G" + str(START_INDEX + NUM_CLAIMS - 1)
-                try:
-                    result = service.spreadsheets().values().get(
-                        spreadsheetId=GENOME_SHEET_ID, range=genome_range).execute()
-                except:
-                    print("I encountered an error.")
-                    time.sleep(30)
-                    continue
-                if result.get('values') is None:
-                    range_ = "D" + str(START_INDEX) + ":D" + str(START_INDEX + NUM_CLAIMS - 1)  
-
-                    clear_values_request_body = {
-                       
-                    }
-
-                    clearFlag = False
-                    while clearFlag == False:
-                        try:
-                            request = service.spreadsheets().values().clear(spreadsheetId=GENOME_SHEET_ID, range=range_, body=clear_values_request_body)
-                            response = request.execute()
-                            clearFlag = True
-    
-                        except:
-                            print("I encountered an error.")
-                            time.sleep(30)
-                            clearFlag = True
-                            continue
-                    continue
-                brains = []  #I collect the genomes and put them into the markov brain object according to its structure.
-                             # The way you construct phenotype from genotype is dependant on the specifics of your GA.
-                for x in range(NUM_CLAIMS):
-                    sequence = []
-                    genome = result.get('values')[x][0]
-                    value = ""
-                    for y in range(len(genome)):
-                        
-                        if genome[y] != ',':
-                            value = value + genome[y]
-                        else:
-                            if value != "":
-                                sequence.append(int(value))
-                            value = ""
-
-                    current_genome = markov.Genome(len(sequence))
-                    for y in range(len(sequence)):
-                        current_genome.sequence[y] = sequence[y]
-
-                    brain = markov.MarkovBrain(16, current_genome.length, 1, 0, current_genome)
-                    brains.append(brain)
-
-                                      
-                
-                doneFlag = True
-            else:   # all genomes are claimed, wait patiently
-                time.sleep(18)
-                
-            
-                
-        doneFlag = False 
-
-        #Now that you have collected a bunch of chromosome and constructed the phenotype,
-        #  evaluate the brains according to whatever problem domain you are working with.
-        #  This can range from very simple to very complex and is entirely up to you.
-        #  Here I return an arbitrary fitness for the purpose of demonstration.
-        #      I also include room in the sheet for a "validation fitness", or more generally
-        #       you may just think of it as a secondary notion of fitness if you have need for it.
-        for brain in brains:
-            brain.fitness = 100.0 #arbitrary
-            brain.validation_fitness = 100.0 #arbitrary
-
-        #write fitness values to sheet
-        fitness_range = claim_range.replace('D', 'F')
-        val_range = claim_range.replace('D', 'E')
-
-        values = []
-        for c in range(len(brains)):
-            myList = []
-            myStr = str(brains[c].fitness)
-            myList.append(myStr)
-            values.append(myList)
-
-        body = {
-                'values': values
-            }
-
-        
-        doneFlag = False
-        while doneFlag == False:
-            try:
-                result = service.spreadsheets().values().update(spreadsheetId=GENOME_SHEET_ID,range=fitness_range,valueInputOption='RAW', body=body).execute()
-                doneFlag = True
-            except:
-                print("I encountered an error.")
-                time.sleep(30)
-                doneFlag = False
-
-        #If you have no need for 2 notions of fitness you may discard this second round of writing
-        values = []
-        for c in range(len(brains)):
-            myList = []
-            myStr = str(brains[c].validation_fitness)
-            myList.append(myStr)
-            values.append(myList)
-
-        body = {
-                'values': values
-            }
-
-        doneFlag = False
-        while doneFlag == False:
-            try:
-                result = service.spreadsheets().values().update(spreadsheetId=GENOME_SHEET_ID,range=val_range,valueInputOption='RAW', body=body).execute()
-                doneFlag = True
-            except:
-                print("I encountered an error.")
-                time.sleep(30)
-                doneFlag = False
+            works.append(work)
+            for x in work.todo:
+                pending[myPool.submit(Evaluate_Genome, work.genomes[x])] = (work, x)
+
+        if len(pending) == 0:   #idle, wait patiently
+            time.sleep(max(0, nextClaimAt - time.time()))
+            continue
+
+        #Collect results as they stream in, waking up regularly to renew the claims
+        timeout = HEARTBEAT_INTERVAL
+        if nextClaimAt > time.time():
+            timeout = min(timeout, nextClaimAt - time.time())
+        done, _ = concurrent.futures.wait(pending, timeout = timeout, return_when = concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            work, x = pending.pop(future)
+            fitness, val_fitness = future.result()
+            work.record(x, fitness, val_fitness, myCache)
+
+        #write fitness values back for the master, one claim at a time
+        for work in [work for work in works if work.finished()]:
+            myTransport.submit_fitness(work.claim, work.fitnesses, work.val_fitnesses)
+            works.remove(work)
+        for work in works:
+            myTransport.heartbeat(work.claim)
         
         
        
@@ -277,29 +214,29 @@ def Eval_Genomes():
 
 ##### "Main" content ######
 
-# Go through the Google Sheets API authentication if you haven't already.
-
-creds = None
-# The file token.pickle stores the user's access and refresh tokens, and is
-# created automatically when the authorization flow completes for the first
-# time.
-if os.path.exists('token.pickle'):
-    with open('token.pickle', 'rb') as token:
-        creds = pickle.load(token)
-# If there are no (valid) credentials available, let the user log in.
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
+#The worker processes import this file too (on Windows they re-run it), so the main content is
+#  only run by the slave process itself.
+if __name__ == '__main__':
+    if BACKEND == 'local':
+        myTransport = transport.LocalTransport(LOCAL_DB_PATH)
+    elif BACKEND == 'shm':
+        myTransport = transport.SharedMemoryTransport(SHM_NAME)
+    elif len(GENOME_SHARDS) > 0:
+        #One service per shard, as the shards are read and written from threads of their own
+        myClient = api_client.ApiClient(workers = API_WORKERS)
+        myTransport = transport.ShardedTransport([transport.SheetsTransport(sheets_client.build_service(), sheetID, client = myClient, tab = tab,
+                                                                            slaves = NUM_SLAVES, claimsPerSlave = CLAIMS_PER_SLAVE)
+                                                  for sheetID, tab in GENOME_SHARDS], home = SHARD, steal = SHARD_STEAL)
     else:
-        flow = InstalledAppFlow.from_client_secrets_file(
-            'credentials.json', SCOPES)
-        creds = flow.run_local_server()
-    # Save the credentials for the next run
-    with open('token.pickle', 'wb') as token:
-        pickle.dump(creds, token)
+        # Go through the Google Sheets API authentication if you haven't already.
+        myTransport = transport.SheetsTransport(sheets_client.get_service(), GENOME_SHEET_ID, client = api_client.ApiClient(workers = API_WORKERS),
+                                                slaves = NUM_SLAVES, claimsPerSlave = CLAIMS_PER_SLAVE)
 
-service = build('sheets', 'v4', credentials=creds)
-
-print("setup finished; entering Eval_Genomes loop")   #Slave process has started and will enter its running loop indefinitely.
-Eval_Genomes()
+    myCache = fitness_cache.FitnessCache(fitness_cache.config_fingerprint(*EVAL_CONFIG), path = FITNESS_CACHE_PATH)
 
+    print("setup finished; entering Eval_Genomes loop")   #Slave process has started and will enter its running loop indefinitely.
+    if NUM_WORKERS > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = NUM_WORKERS) as myPool:
+            Eval_Genomes_Pool(myTransport, myCache, myPool)
+    else:
+        Eval_Genomes(myTransport, myCache)
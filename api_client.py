@@ -0,0 +1,202 @@
+"""
+Rate-limited, retrying executor for Google API requests.
+
+Every request goes through ApiClient.execute, which
+  - waits on a token bucket (one for reads, one for writes) sized to this process's share
+    of the project's per-minute quota, so several slaves together stay under it;
+  - classifies failures: throttling (429, quota 403s) honours Retry-After, transient
+    failures (5xx, timeouts, lost connections, network and TLS errors, including those of the
+    hourly access token refresh) back off exponentially with jitter, and anything else (bad
+    requests, missing credentials, programming errors) is raised straight away;
+  - counts calls, retries and throttle waits in `stats`.
+
+One client can be shared by several threads (e.g. the shards of a ShardedTransport), which then
+share its quota.
+
+The clock is injectable: with a FakeClock nothing actually sleeps, so the policies can be
+exercised offline (python api_client_check.py).
+"""
+
+import collections
+import errno
+import http.client
+import random
+import socket
+import ssl
+import threading
+import time
+
+from polling import PollingPolicy
+
+
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+#Reasons the API gives in the body of a 403 that is really a quota rejection
+QUOTA_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED', 'RESOURCE_EXHAUSTED')
+
+
+class RealClock:
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+#Time only moves when something sleeps on it
+class FakeClock:
+    def __init__(self, now = 0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+#`rate` tokens per second, at most `capacity` saved up
+class TokenBucket:
+    def __init__(self, rate, capacity, clock):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updatedAt = clock.time()
+        self.lock = threading.Lock()   #threads queue up for the tokens
+
+    def _refill(self):
+        now = self.clock.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    #Take one token, sleeping until there is one; returns how long it waited
+    def acquire(self):
+        with self.lock:
+            self._refill()
+            waited = 0.0
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                self.clock.sleep(wait)
+                waited = wait
+                self._refill()
+            self.tokens -= 1
+            return waited
+
+
+#HTTP status of an API error, if it has one (googleapiclient's HttpError keeps the response in .resp)
+def _status(error):
+    resp = getattr(error, 'resp', None)
+    status = getattr(resp, 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+#Seconds asked for by a Retry-After header, or None
+def retry_after(error):
+    resp = getattr(error, 'resp', None)
+    if resp is None or not hasattr(resp, 'get'):
+        return None
+    value = resp.get('retry-after') or resp.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None   #an HTTP date; fall back to the backoff
+
+
+#Network failures worth retrying: timeouts, lost and reset connections, TLS failures, failed DNS
+#  lookups and responses cut short. Other OSErrors (a missing token or credentials file, a bad path)
+#  are not, unless their errno says the network is down or unreachable.
+NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError, http.client.HTTPException)
+NETWORK_ERRNOS = frozenset((errno.ENETUNREACH, errno.EHOSTUNREACH, errno.ENETDOWN, errno.ECONNREFUSED, errno.EADDRNOTAVAIL))
+
+#Whether `error` is an instance of the google.auth.exceptions class `name` (google-auth is only
+#  imported by sheets_client)
+def _auth_error(error, name):
+    return any(cls.__module__ == 'google.auth.exceptions' and cls.__name__ == name for cls in type(error).__mro__)
+
+def classify(error):
+    status = _status(error)
+    if status is None:
+        if isinstance(error, NETWORK_ERRORS):
+            return TRANSIENT
+        #httplib2 re-raises these plain OSErrors once its own retry gives up
+        if isinstance(error, OSError) and error.errno in NETWORK_ERRNOS:
+            return TRANSIENT
+        #httplib2 reports lost connections with its own exception types
+        if type(error).__module__.startswith('httplib2'):
+            return TRANSIENT
+        #The access token is refreshed from within request.execute() about once an hour: a network
+        #  failure then is a TransportError, and the token endpoint failing is a RefreshError, worth
+        #  retrying when google-auth marks it retryable or it was caused by a 5xx, 429 or network failure
+        if _auth_error(error, 'TransportError'):
+            return TRANSIENT
+        if _auth_error(error, 'RefreshError'):
+            cause = error.__cause__ or error.__context__
+            if getattr(error, 'retryable', False) or (cause is not None and classify(cause) != FATAL):
+                return TRANSIENT
+        return FATAL
+    if status == 429:
+        return THROTTLED
+    if status == 403:
+        content = getattr(error, 'content', b'')
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return THROTTLED if any(reason in str(content) for reason in QUOTA_REASONS) else FATAL
+    if status == 408 or status >= 500:
+        return TRANSIENT
+    return FATAL
+
+
+#Executes requests within a share of the quota. The defaults are the Sheets API's per-user
+#  quotas (60 reads and 60 writes per minute); `workers` is how many processes share them.
+class ApiClient:
+    def __init__(self, readsPerMinute = 60, writesPerMinute = 60, workers = 1, burst = 5, maxRetries = None,
+                 backoffFloor = 1.0, backoffCeiling = 64.0, clock = None):
+        self.clock = clock if clock is not None else RealClock()
+        self.reads = TokenBucket(readsPerMinute / 60.0 / workers, burst, self.clock)
+        self.writes = TokenBucket(writesPerMinute / 60.0 / workers, burst, self.clock)
+        self.maxRetries = maxRetries    #None retries throttling and transient errors forever
+        self.backoffFloor = backoffFloor
+        self.backoffCeiling = backoffCeiling
+        self.rng = random.Random()      #backoff jitter, kept off the GA's generator
+        self.stats = collections.Counter()
+        self.statsLock = threading.Lock()
+
+    def _count(self, key, amount = 1):
+        with self.statsLock:
+            self.stats[key] += amount
+
+    #Run request.execute() and return its response; `write` picks the quota it counts against
+    def execute(self, request, write = False):
+        bucket = self.writes if write else self.reads
+        backoff = PollingPolicy(self.backoffFloor, self.backoffCeiling, sleep = self.clock.sleep, rng = self.rng)
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited > 0:
+                self._count('throttle_waits')
+                self._count('throttle_seconds', waited)
+            self._count('calls')
+            try:
+                response = request.execute()
+            except Exception as error:
+                kind = classify(error)
+                self._count(kind)
+                if kind == FATAL or (self.maxRetries is not None and attempt >= self.maxRetries):
+                    raise
+                attempt += 1
+                self._count('retries')
+                delay = backoff.next_delay()
+                if kind == THROTTLED:
+                    delay = max(delay, retry_after(error) or 0.0)
+                    self._count('throttle_waits')
+                    self._count('throttle_seconds', delay)
+                print("I encountered an error (" + kind + "), retrying in " + str(round(delay, 1)) + " seconds.")
+                self.clock.sleep(delay)
+                continue
+            return response
@@ -0,0 +1,111 @@
+"""
+Checks how api_client classifies failures and what ApiClient.execute does with them, offline: the
+client runs on a FakeClock, so its backoff and quota waits only move the fake time forward.
+
+Network failures (lost connections, timeouts, TLS errors, failed DNS lookups, responses cut short
+and plain OSErrors whose errno says the network is down or unreachable, as httplib2 re-raises
+them) must be retried; file errors such as a missing token or credentials file must be raised at
+once. Backing off must stay under its ceiling and must not draw from the module-level random
+generator, which the GA breeds with.
+
+Run it with no arguments: python api_client_check.py
+"""
+
+import errno
+import http.client
+import random
+import socket
+import ssl
+
+import api_client
+
+
+TRANSIENT_ERRORS = [
+    ConnectionResetError(errno.ECONNRESET, 'Connection reset by peer'),
+    ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused'),
+    TimeoutError('timed out'),
+    socket.timeout('timed out'),
+    socket.gaierror(socket.EAI_AGAIN, 'Temporary failure in name resolution'),
+    ssl.SSLError('EOF occurred in violation of protocol'),
+    http.client.IncompleteRead(b''),
+    OSError(errno.ENETUNREACH, 'Network is unreachable'),
+    OSError(errno.EHOSTUNREACH, 'No route to host'),
+    OSError(errno.ENETDOWN, 'Network is down'),
+    OSError(errno.ECONNREFUSED, 'Connection refused'),
+    OSError(errno.EADDRNOTAVAIL, 'Cannot assign requested address'),
+]
+
+FATAL_ERRORS = [
+    FileNotFoundError(errno.ENOENT, 'No such file or directory', 'token.pickle'),
+    PermissionError(errno.EACCES, 'Permission denied', 'credentials.json'),
+    OSError('bad path'),
+    ValueError('bad range'),
+]
+
+
+#A request that raises the errors it is given, in order, then returns 'done'
+class FailingRequest:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'done'
+
+
+def check_classify():
+    for error in TRANSIENT_ERRORS:
+        if api_client.classify(error) != api_client.TRANSIENT:
+            raise AssertionError(repr(error) + " should be transient, not " + api_client.classify(error))
+    for error in FATAL_ERRORS:
+        if api_client.classify(error) != api_client.FATAL:
+            raise AssertionError(repr(error) + " should be fatal, not " + api_client.classify(error))
+
+
+#A FakeClock that remembers every wait
+class RecordingClock(api_client.FakeClock):
+    def __init__(self):
+        api_client.FakeClock.__init__(self)
+        self.waits = []
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        api_client.FakeClock.sleep(self, seconds)
+
+
+def check_execute():
+    clock = RecordingClock()
+    client = api_client.ApiClient(clock = clock)
+    request = FailingRequest(TRANSIENT_ERRORS)
+    state = random.getstate()
+    if client.execute(request) != 'done' or request.calls != len(TRANSIENT_ERRORS) + 1:
+        raise AssertionError("execute did not retry every transient error")
+    if client.stats['retries'] != len(TRANSIENT_ERRORS) or clock.now <= 0:
+        raise AssertionError("execute did not back off between retries")
+    if max(clock.waits) > client.backoffCeiling:
+        raise AssertionError("execute backed off for " + str(max(clock.waits)) + " seconds, over its ceiling")
+    if random.getstate() != state:
+        raise AssertionError("execute drew its backoff jitter from the module-level random generator")
+    for error in FATAL_ERRORS:
+        request = FailingRequest([error])
+        try:
+            client.execute(request)
+        except type(error):
+            pass
+        else:
+            raise AssertionError(repr(error) + " was retried instead of raised")
+        if request.calls != 1:
+            raise AssertionError(repr(error) + " was retried " + str(request.calls - 1) + " times")
+
+
+def run():
+    check_classify()
+    check_execute()
+    print("api_client retries " + str(len(TRANSIENT_ERRORS)) + " network failures and raises " + str(len(FATAL_ERRORS)) + " other errors")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,68 @@
+"""
+Times MarkovBrain.activate on the gate objects against the same brains compiled into a
+BrainProgram (MarkovBrain.compile), and checks on the way that both give the same states.
+
+Random genomes have few gates (a start codon is two matching genes), so the benchmark plants
+start codons in them to get brains of the sizes evolution produces. Compiling a brain takes about
+as long as 70 activations on its gate objects, so it pays off for brains activated more than a
+hundred times or so.
+
+Run it with no arguments: python brain_benchmark.py
+"""
+
+import random
+import time
+
+import markov
+
+
+#(brain size in nodes, genome length, start codons planted) of each benchmarked brain
+BENCHMARK_BRAINS = [(16, 5000, 10), (16, 5000, 100), (64, 20000, 300), (256, 50000, 1000), (1024, 50000, 3000)]
+BENCHMARK_ACTIVATIONS = 200
+BENCHMARK_INPUTS = 8
+
+
+#A random genome with `gates` start codons written into it at random places
+def planted_genome(length, gates):
+    genome = markov.Genome(length)
+    for x in range(gates):
+        y = random.randrange(length - 1)
+        codon = random.randint(markov.FIRST_START_CODON, markov.LAST_START_CODON)
+        genome.genes[y] = codon
+        genome.genes[y + 1] = 255 - codon
+    return genome
+
+
+#Seconds `brain` takes for the activations, and the state it ends in
+def time_activations(brain, inputs, seed):
+    random.seed(seed)
+    start = time.perf_counter()
+    for values in inputs:
+        brain.activate(values)
+    return time.perf_counter() - start, brain.brainState
+
+
+def benchmark(brains = BENCHMARK_BRAINS, activations = BENCHMARK_ACTIVATIONS, seed = 0):
+    random.seed(seed)
+    print("  nodes   gates   objects (ms)   program (ms)   speedup")
+    for size, length, planted in brains:
+        genome = planted_genome(length, planted)
+        inputs = [[random.choice([0, 1]) for x in range(min(size, BENCHMARK_INPUTS))] for y in range(activations)]
+        objects = markov.MarkovBrain(size, genome.length, 1, 0, genome)
+        compiled = markov.MarkovBrain(size, genome.length, 1, 0, genome)
+        start = time.perf_counter()
+        compiled.compile()
+        compileTime = time.perf_counter() - start
+
+        objectTime, objectState = time_activations(objects, inputs, seed)
+        programTime, programState = time_activations(compiled, inputs, seed)
+        if [repr(value) for value in objectState] != [repr(value) for value in programState]:   #NaN != NaN
+            print("  The program's state differs from the gate objects' for a brain of " + str(size) + " nodes")
+
+        print("%7d %7d %14.3f %14.3f %9.1fx" % (size, len(objects.gates), 1000 * objectTime / activations,
+                                                 1000 * programTime / activations, objectTime / programTime)
+              + "   (compiled in " + str(round(1000 * compileTime, 1)) + " ms)")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,173 @@
+"""
+Checkpoints of a MarkovPopulation, so a master that crashed or was stopped picks the run up
+where it left off instead of starting over from random genomes.
+
+A checkpoint is two files:
+  - the genome file "<path>.genomes.<n>", where genome bodies are only ever appended as raw
+    bytes (one byte per gene). A brain keeps its genome for life, so each body is written once,
+    by the first checkpoint that sees its brain; elites carried over cost nothing afterwards.
+  - the state file at `path`: a small binary record of the counters, the random number
+    generator and every brain (ID, fitnesses, steady-state flags and where its genome is).
+    It is replaced in one step, after the genome file was flushed to disk, so whatever is on
+    disk is always a complete checkpoint.
+Once the genome file holds compactRatio times more bytes than the live genomes, the next
+checkpoint writes the live genomes to a new genome file and removes the old one.
+"""
+
+import os
+import random
+import struct
+
+import markov
+
+
+CHECKPOINT_MAGIC = b'MKCP'
+CHECKPOINT_VERSION = 1
+
+#magic, version, gen, idCounter, told, genome file number, genome file length, untested set up, brains
+HEADER = struct.Struct('<4sHqqqqqBI')
+#Python's random module state: version, gauss_next set, gauss_next, then the 625 words of the Mersenne Twister
+RANDOM_HEADER = struct.Struct('<IBd')
+RANDOM_WORDS = struct.Struct('<625I')
+#ID, fitness, validation fitness, normalized fitness, flags, offset and length of the genome
+BRAIN = struct.Struct('<qdddBQQ')
+
+#Flags of a brain record
+IN_POPULATION, ASKED, UNTESTED, UNEVALUATED = 1, 2, 4, 8
+
+
+#Writes and reads the checkpoints of one run at `path`
+class Checkpoint:
+    def __init__(self, path, compactRatio = 3.0):
+        self.path = path
+        self.compactRatio = compactRatio
+        self.number = 0           #of the genome file in use
+        self.length = 0           #bytes of it that belong to a checkpoint
+        self.locations = {}       #brain ID -> (offset, length) of its genome in the genome file
+
+    def _genome_path(self, number):
+        return self.path + ".genomes." + str(number)
+
+    #Every brain the population holds, in order, with its flags
+    def _brains(self, population, brains):
+        flags = {}
+        order = []
+        def add(brain, flag):
+            if brain.ID not in flags:
+                flags[brain.ID] = 0
+                order.append(brain)
+            flags[brain.ID] |= flag
+        for brain in brains:
+            add(brain, IN_POPULATION)
+        for brain in population.asked.values():
+            add(brain, ASKED)
+        for brain in population.untested or []:
+            add(brain, UNTESTED)
+        for brain in order:
+            if brain.ID in population.unevaluated:
+                flags[brain.ID] |= UNEVALUATED
+        return order, flags
+
+    #Write a checkpoint of `population`. `brains` gives its brains in the order to restore them in
+    #  (e.g. the order they were published in); population.brains by default.
+    def save(self, population, brains = None):
+        if brains is None:
+            brains = population.brains
+        order, flags = self._brains(population, brains)
+
+        #Start a new genome file once the current one is mostly dead genomes
+        live = dict((brain.ID, self.locations[brain.ID]) for brain in order if brain.ID in self.locations)
+        liveBytes = sum(length for offset, length in live.values()) + sum(brain.genome.length for brain in order if brain.ID not in live)
+        if self.length > self.compactRatio * max(1, liveBytes):
+            previous = self.number
+            self.number += 1
+            self.length = 0
+            live = {}
+        else:
+            previous = None
+
+        #Append the genomes the genome file doesn't have yet
+        with open(self._genome_path(self.number), 'r+b' if self.length > 0 else 'wb') as genomeFile:
+            genomeFile.truncate(self.length)   #anything past it was left by an interrupted checkpoint
+            genomeFile.seek(self.length)
+            for brain in order:
+                if brain.ID not in live:
+                    data = brain.genome.to_bytes()
+                    genomeFile.write(data)
+                    live[brain.ID] = (self.length, len(data))
+                    self.length += len(data)
+            genomeFile.flush()
+            os.fsync(genomeFile.fileno())
+        self.locations = live
+
+        state = random.getstate()
+        parts = [HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, population.gen, population.idCounter, population.told,
+                             self.number, self.length, population.untested is not None, len(order)),
+                 RANDOM_HEADER.pack(state[0], state[2] is not None, state[2] or 0.0),
+                 RANDOM_WORDS.pack(*state[1])]
+        for brain in order:
+            parts.append(BRAIN.pack(brain.ID, brain.fitness, brain.validation_fitness, brain.normalized_fitness,
+                                    flags[brain.ID], live[brain.ID][0], live[brain.ID][1]))
+        tempPath = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(tempPath, 'wb') as stateFile:
+            stateFile.write(b''.join(parts))
+            stateFile.flush()
+            os.fsync(stateFile.fileno())
+        os.replace(tempPath, self.path)
+
+        if previous is not None and os.path.exists(self._genome_path(previous)):
+            os.remove(self._genome_path(previous))
+
+    #Restore the last checkpoint into `population`, which must have been created with the same
+    #  parameters. Returns False (and leaves the population alone) if there is no checkpoint.
+    def load(self, population):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as stateFile:
+            data = stateFile.read()
+        magic, version, gen, idCounter, told, number, length, untestedSet, count = HEADER.unpack_from(data, 0)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise ValueError("Not a checkpoint this version can read: " + self.path)
+        offset = HEADER.size
+        randomVersion, hasGauss, gauss = RANDOM_HEADER.unpack_from(data, offset)
+        offset += RANDOM_HEADER.size
+        words = RANDOM_WORDS.unpack_from(data, offset)
+        offset += RANDOM_WORDS.size
+
+        brains = []
+        asked = {}
+        untested = []
+        unevaluated = set()
+        locations = {}
+        with open(self._genome_path(number), 'rb') as genomeFile:
+            for x in range(count):
+                ID, fitness, validation_fitness, normalized_fitness, flags, genomeOffset, genomeLength = BRAIN.unpack_from(data, offset)
+                offset += BRAIN.size
+                genomeFile.seek(genomeOffset)
+                genome = markov.Genome.from_bytes(genomeFile.read(genomeLength))
+                brain = markov.Individual(ID, genome)
+                brain.fitness = fitness
+                brain.validation_fitness = validation_fitness
+                brain.normalized_fitness = normalized_fitness
+                if flags & IN_POPULATION:
+                    brains.append(brain)
+                if flags & ASKED:
+                    asked[ID] = brain
+                if flags & UNTESTED:
+                    untested.append(brain)
+                if flags & UNEVALUATED:
+                    unevaluated.add(ID)
+                locations[ID] = (genomeOffset, genomeLength)
+
+        population.brains = brains
+        population.gen = gen
+        population.idCounter = idCounter
+        population.told = told
+        population.asked = asked
+        population.untested = untested if untestedSet else None
+        population.unevaluated = unevaluated
+        random.setstate((randomVersion, words, gauss if hasGauss else None))
+        self.number = number
+        self.length = length
+        self.locations = locations
+        return True
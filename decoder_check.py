@@ -0,0 +1,137 @@
+"""
+Checks markov.decode_gates against the decoder it replaced, which read the genome one position
+at a time (wrapping around with % length) in MarkovBrain.__init__. Both must find the same gates,
+in the same order, with the same type, inputs, outputs and parameters (truth tables, thresholds,
+timers, neuron weights, operations).
+
+The genomes checked are random ones (which have few gates), ones with start codons planted at
+random, genomes shorter than one gate and genomes with start codons in their last positions,
+whose gates wrap around to the beginning of the genome.
+
+Run it with no arguments: python decoder_check.py
+"""
+
+import random
+
+import markov
+
+
+#The decoder of the original MarkovBrain.__init__, kept as the reference
+def reference_gates(sequence, size):
+    length = len(sequence)
+    def gene(y):
+        return sequence[y % length]
+    gates = []
+    for y in range(length):
+        codon = gene(y)
+        if codon < markov.FIRST_START_CODON or codon > markov.LAST_START_CODON or gene(y + 1) != 255 - codon:
+            continue
+        numInputs = (gene(y + 2) % 4) + 1
+        numOutputs = (gene(y + 3) % 4) + 1
+        inputIndices = []
+        for x in range(numInputs):
+            inputIndices.append(gene(y + 4 + x) % size)
+        outputIndices = []
+        for x in range(numOutputs):
+            outputIndices.append(gene(y + 8 + x) % size)
+
+        if codon == 42:     #deterministic logic gate
+            tableValues = []
+            for x in range(2**numInputs):
+                bString = ('{0:04b}'.format(gene(y + 12 + x)))
+                value = []
+                for z in range(numOutputs):
+                    value.append(int(bString[len(bString) - 1 - z]))
+                tableValues.append(value)
+            gates.append(markov.DeterministicGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 43:   #probabilistic logic gate
+            tableValues = []
+            for x in range(2**numInputs):
+                row = []
+                for z in range(2**numOutputs):
+                    row.append(gene(y + 12 + x))
+                tableValues.append(row)
+            for x in range(2**numInputs):
+                denom = 0
+                for z in range(2**numOutputs):
+                    denom += (1 + tableValues[x][z])
+                for z in range(2**numOutputs):
+                    tableValues[x][z] = (tableValues[x][z] + 1)/denom
+            gates.append(markov.ProbabilisticGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 44:   #threshold gate
+            gates.append(markov.ThresholdGate(numInputs, numOutputs, inputIndices, outputIndices, gene(y + 12) % markov.THRESHOLD_CONSTANT))
+        elif codon == 45:   #timer gate
+            gates.append(markov.TimerGate(numOutputs, outputIndices, gene(y + 12) % markov.TIMER_CONSTANT))
+        elif codon == 46:   #ternary logic gate
+            tableValues = []
+            for x in range(3**numInputs):
+                tString = list(markov.ternary(gene(y + 12 + x)))
+                while len(tString) < numOutputs:
+                    tString = [0] + tString
+                value = []
+                for z in range(numOutputs):
+                    value.append(int(tString[len(tString) - 1 - z]) - 1)
+                tableValues.append(value)
+            gates.append(markov.TernaryGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 47:   #artificial neuron gate
+            numNeurons = (gene(y + 12) % 4) + 1
+            weights = []
+            for x in range((numInputs + 1) * numNeurons):
+                weights.append((gene(y + 13 + x) - 128.0)/100.0)
+            gates.append(markov.NNGate(numInputs, numOutputs, inputIndices, outputIndices, numNeurons, weights))
+        elif codon == 48:   #stats gate
+            gates.append(markov.StatsGate(numInputs, numOutputs, inputIndices, outputIndices, gene(y + 12) % 3))
+        elif codon == 49:   #sum gate
+            gates.append(markov.SumGate(numInputs, numOutputs, inputIndices, outputIndices))
+        elif codon == 50:   #NULL gate
+            gates.append(markov.NullGate(numOutputs, outputIndices))
+        else:               #invert gate
+            gates.append(markov.InvertGate(numInputs, numOutputs, inputIndices, outputIndices, gene(y + 12) % 2))
+    return gates
+
+
+#Everything that tells two gates apart
+def describe(gate):
+    return dict((name, value) for name, value in vars(gate).items() if name not in ('accumulator', 'updates'))
+
+
+#A random genome of `length` genes with `codons` start codons planted, `atEnd` of them in its last positions
+def planted_sequence(length, codons, atEnd = 0):
+    sequence = bytearray(random.getrandbits(8) for x in range(length))
+    places = [random.randrange(length) for x in range(codons)] + [length - 1 - x for x in range(min(atEnd, length))]
+    for y in places:
+        codon = random.randint(markov.FIRST_START_CODON, markov.LAST_START_CODON)
+        sequence[y] = codon
+        sequence[(y + 1) % length] = 255 - codon
+    return sequence
+
+
+def check(sequence, size):
+    expected = [describe(gate) for gate in reference_gates(sequence, size)]
+    found = [describe(gate) for gate in markov.decode_gates(sequence, size)]
+    if found != expected:
+        raise AssertionError("decode_gates differs from the reference on a genome of " + str(len(sequence)) + " genes: "
+                             + str(len(found)) + " gates against " + str(len(expected)))
+    return len(expected)
+
+
+def run(seed = 0):
+    random.seed(seed)
+    genomes = 0
+    gates = 0
+    cases = []
+    cases += [(bytearray(random.getrandbits(8) for x in range(length)), size) for length in (1000, 5000) for size in (16, 64) for x in range(20)]
+    cases += [(planted_sequence(length, codons), size) for length in (200, 2000) for codons in (5, 50) for size in (8, 16, 256) for x in range(10)]
+    #Shorter than one gate: every gate wraps around the genome, some of them several times
+    cases += [(planted_sequence(length, 1), size) for length in range(1, markov.GATE_READ_LENGTH + 2) for size in (4, 16)]
+    #Start codons in the last positions, including one split between the last and the first gene
+    cases += [(planted_sequence(length, 0, atEnd), 16) for length in (50, 120, 500) for atEnd in (1, 2, 5) for x in range(10)]
+    cases += [(bytearray(), 16)]
+    for sequence, size in cases:
+        gates += check(sequence, size)
+        genomes += 1
+    print("decode_gates matches the reference decoder on " + str(genomes) + " genomes (" + str(gates) + " gates)")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,72 @@
+"""
+Fitness memoization keyed by genome content hash.
+
+Elites carried over by MarkovPopulation.eval_genomes, and duplicate children, have
+the same genome (and so the same markov.Genome.content_hash()) as something that
+was already evaluated. The master pre-fills their fitnesses when publishing a
+generation so slaves never claim them, and slaves check the cache before running
+an evaluation.
+
+Cached values are only valid for one evaluation setup, so every cache carries a
+fingerprint of that setup (see config_fingerprint); a persisted cache written under
+a different fingerprint is ignored.
+"""
+
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+
+
+#Fingerprint of an evaluation setup, from any values that change what fitness a genome gets
+#  (problem domain version, brain size, brain steps...)
+def config_fingerprint(*values):
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size = 8).hexdigest()
+
+
+#A bounded genome hash -> (fitness, validation_fitness) map with least recently used eviction.
+#  If a path is given the cache is loaded from it on creation and written back by save().
+class FitnessCache:
+    def __init__(self, fingerprint, maxSize = 100000, path = None):
+        self.fingerprint = fingerprint
+        self.maxSize = maxSize
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, fitness, validation_fitness):
+        self.entries[key] = (fitness, validation_fitness)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last = False)
+
+    def load(self):
+        with open(self.path, 'rb') as cacheFile:
+            fingerprint, entries = pickle.load(cacheFile)
+        if fingerprint == self.fingerprint:
+            for key, value in entries:
+                self.put(key, value[0], value[1])
+
+    #Write the cache to its path; the file is replaced in one step so a reader never sees half a cache
+    def save(self):
+        if self.path is None:
+            return
+        tempPath = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(tempPath, 'wb') as cacheFile:
+            pickle.dump((self.fingerprint, list(self.entries.items())), cacheFile, pickle.HIGHEST_PROTOCOL)
+        os.replace(tempPath, self.path)
@@ -0,0 +1,51 @@
+"""
+Content-addressed genome storage.
+
+Genomes are identified by markov.Genome.content_hash(), so a genome that was
+already sent (an elite carried over by MarkovPopulation.eval_genomes, or a
+duplicate child) never has to be uploaded or decoded again. The master only
+publishes a manifest of hashes per generation plus the bodies the store has not
+seen; each slave keeps a GenomeStore of the bodies it has already downloaded.
+"""
+
+from collections import OrderedDict
+
+
+#A bounded hash -> Genome map. The least recently used genomes are dropped first
+#  once more than maxSize genomes are held.
+class GenomeStore:
+    def __init__(self, maxSize = 1000):
+        self.maxSize = maxSize
+        self.genomes = OrderedDict()
+
+    def __len__(self):
+        return len(self.genomes)
+
+    def __contains__(self, key):
+        return key in self.genomes
+
+    def get(self, key):
+        genome = self.genomes.get(key)
+        if genome is not None:
+            self.genomes.move_to_end(key)
+        return genome
+
+    #Store a genome under the given hash (computed if not given) and return the hash
+    def put(self, genome, key = None):
+        if key is None:
+            key = genome.content_hash()
+        self.genomes[key] = genome
+        self.genomes.move_to_end(key)
+        while len(self.genomes) > self.maxSize:
+            self.genomes.popitem(last = False)
+        return key
+
+    #The hashes of the list that this store does not hold, without duplicates and in order
+    def missing(self, keys):
+        result = []
+        seen = set()
+        for key in keys:
+            if key not in self.genomes and key not in seen:
+                result.append(key)
+                seen.add(key)
+        return result
@@ -8,15 +8,23 @@
 
 ##################################
 # In this code the greatest emphasis was placed on clarity of structure and readability.
-# No effort has been made to optimize.
+# The hot paths have been optimized since, each checked against the code it replaced:
+#   - decode_gates finds a genome's gates in one NumPy pass (python decoder_check.py);
+#   - Genome keeps its genes in a bytearray, and Genome.mutate draws only the sites it
+#     changes (mutation_sites) in one pass over the genome (python mutation_check.py);
+#   - MarkovBrain decodes its gates only when they are first used, and MarkovBrain.compile
+#     turns them into one Python function (python brain_benchmark.py).
 #
 # See "example.py" for a demonstration on using the code defined here.
 ##################################
 import random
 import math
 import numpy
+import base64
+import zlib
+import hashlib
 from functools import reduce
-from collections import Counter
+from collections import Counter, deque
 
 
 #These constants are arbitrary and may be changed based on intuition, performance constraints,
@@ -27,6 +35,13 @@ THRESHOLD_CONSTANT = 48
 TIMER_CONSTANT = 96
 MAX_GENOME_CONSTANT = 50000
 
+#Wire format for sending genomes between processes (see Genome.encode). Genes are always 0-255,
+#  so a genome is sent as its raw bytes in base64, optionally zlib-compressed, behind a short
+#  header naming the format version. Text longer than CELL_CHARACTER_LIMIT (the per-cell limit
+#  of Google Sheets) is split over several cells.
+GENOME_ENCODING_VERSION = 1
+CELL_CHARACTER_LIMIT = 50000
+
 #Function to produce ternary string of decimal number (used for ternary gate)
 def ternary(n):
     if n == 0:
@@ -37,6 +52,68 @@ def ternary(n):
         nums.append(str(r))
     return ''.join(reversed(nums))
 
+#Lookup tables for decode_gates: the bits (lowest first) and the ternary digits (lowest first, as -1..1)
+#  of every gene value, as used for the truth tables of deterministic and ternary gates
+GENE_BITS = [[(value >> z) & 1 for z in range(4)] for value in range(256)]
+GENE_TRITS = [[(value // 3**z) % 3 - 1 for z in range(4)] for value in range(256)]
+
+#Start codons: a gate starts wherever a gene between 42 and 51 is followed by 255 minus itself
+FIRST_START_CODON = 42
+LAST_START_CODON = 51
+
+#How far past its start codon a gate reads (a ternary gate with 4 inputs reads 81 table genes from y + 12)
+GATE_READ_LENGTH = 12 + 3**4
+
+#Build the gates encoded in a genome (a sequence of genes 0-255) for a brain of `size` nodes.
+#  The start codons are found in one NumPy pass; the genome wraps around, so it is extended with its
+#  own beginning and every gate is read from a plain slice.
+def decode_gates(sequence, size):
+    length = len(sequence)
+    if length == 0:
+        return []
+    genes = numpy.frombuffer(bytes(sequence), dtype = numpy.uint8)
+    padded = genes[numpy.arange(length + GATE_READ_LENGTH) % length]
+    first = padded[:length].astype(numpy.int16)
+    starts = numpy.flatnonzero((first >= FIRST_START_CODON) & (first <= LAST_START_CODON) & (first + padded[1:length + 1] == 255))
+
+    gates = []
+    for y in starts.tolist():
+        g = padded[y:y + GATE_READ_LENGTH + 1].tolist()
+        codon = g[0]
+        numInputs = (g[2] % 4) + 1
+        numOutputs = (g[3] % 4) + 1
+        inputIndices = [value % size for value in g[4:4 + numInputs]]
+        outputIndices = [value % size for value in g[8:8 + numOutputs]]
+        if codon == 42:     #deterministic logic gate
+            tableValues = [GENE_BITS[value][:numOutputs] for value in g[12:12 + 2**numInputs]]
+            gates.append(DeterministicGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 43:   #probabilistic logic gate, every output equally likely
+            tableValues = []
+            for value in g[12:12 + 2**numInputs]:
+                denom = (1 + value) * 2**numOutputs
+                tableValues.append([(value + 1)/denom for z in range(2**numOutputs)])
+            gates.append(ProbabilisticGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 44:   #threshold gate
+            gates.append(ThresholdGate(numInputs, numOutputs, inputIndices, outputIndices, g[12] % THRESHOLD_CONSTANT))
+        elif codon == 45:   #timer gate
+            gates.append(TimerGate(numOutputs, outputIndices, g[12] % TIMER_CONSTANT))
+        elif codon == 46:   #ternary logic gate
+            tableValues = [GENE_TRITS[value][:numOutputs] for value in g[12:12 + 3**numInputs]]
+            gates.append(TernaryGate(numInputs, numOutputs, inputIndices, outputIndices, tableValues))
+        elif codon == 47:   #artificial neuron gate
+            numNeurons = (g[12] % 4) + 1
+            weights = [(value - 128.0)/100.0 for value in g[13:13 + (numInputs + 1) * numNeurons]]
+            gates.append(NNGate(numInputs, numOutputs, inputIndices, outputIndices, numNeurons, weights))
+        elif codon == 48:   #stats gate (min, max or average)
+            gates.append(StatsGate(numInputs, numOutputs, inputIndices, outputIndices, g[12] % 3))
+        elif codon == 49:   #sum gate
+            gates.append(SumGate(numInputs, numOutputs, inputIndices, outputIndices))
+        elif codon == 50:   #NULL gate
+            gates.append(NullGate(numOutputs, outputIndices))
+        else:               #invert gate
+            gates.append(InvertGate(numInputs, numOutputs, inputIndices, outputIndices, g[12] % 2))
+    return gates
+
 class MarkovPopulation:
     def __init__(self, popSize, brainSize, genome_length, brain_steps, elitism, diversity_generate, point_mutation, insert_mutation, delete_mutation, copy_mutation, big_delete_mutation, big_copy_mutation, prob_engulf, fitness_sharing, preserve_diversity):
         self.brains = []
@@ -59,10 +136,53 @@ class MarkovPopulation:
         self.preserve_diversity = preserve_diversity
         
         for x in range(popSize):
-            self.brains.append(MarkovBrain(self.brainSize, self.genome_length, self.brain_steps, self.idCounter))
+            self.brains.append(Individual(self.idCounter, Genome(self.genome_length)))
             self.idCounter = self.idCounter + 1
 
-    def eval_genomes(self):
+        #Steady-state mode (ask/tell): brains handed out and not told yet by ID, and the initial brains
+        #  that are not evaluated yet (set up by the first ask)
+        self.asked = {}
+        self.untested = None
+        self.unevaluated = set()
+        self.told = 0
+
+    #New random individuals, as used for diversity in every generation. They don't depend on the
+    #  current generation, so they can be created (and evaluated) ahead of time and handed to eval_genomes.
+    def random_brains(self, count):
+        brains = []
+        for x in range(count):
+            brains.append(Individual(self.idCounter, Genome(self.genome_length)))
+            self.idCounter = self.idCounter + 1
+        return brains
+
+    #Create a child genome from two parent genomes: crossover (or engulfing), then mutation
+    def breed(self, parent1, parent2):
+        genes = parent1.genes     #Genome of parent 1
+        genes2 = parent2.genes    #Genome of parent 2
+
+        #create child genome from parents': half of each parent, read from a random point (wrapping around)
+        index = random.randint(0, len(genes) - 1)
+        index2 = random.randint(0, len(genes2) - 1)
+
+        child_genes = (genes[index:] + genes[:index])[:math.floor(len(genes) / 2)]
+        child_genes += (genes2[index2:] + genes2[:index2])[:math.floor(len(genes2) / 2)]
+
+        e_spin = random.uniform(0, 1)
+        if e_spin < self.prob_engulf:   #If genome was engulfed, do this instead of crossover
+            engulf_point = random.randint(0, len(genes) - 1)
+            child_genome = Genome.from_bytes(genes[:engulf_point] + genes2 + genes[engulf_point:])
+        else:   #Use child obtained from normal crossover 
+            child_genome = Genome.from_bytes(child_genes)
+
+        #mutate genome
+        child_genome.mutate(self.point_mutation, self.insert_mutation, self.delete_mutation, self.copy_mutation, self.big_delete_mutation, self.big_copy_mutation)
+        return child_genome
+
+    #Create the next generation from the fitnesses of this one.
+    #  randoms: random individuals made in advance with random_brains, used before making new ones
+    #  publish: called with each brain of the next generation as soon as it is fixed (elites first,
+    #    then each child as it is bred, then the random individuals), so evaluation can start early
+    def eval_genomes(self, randoms = None, publish = None):
         print("\n\n****** MARKOV PYTHON ||||| GENERATION STEP " + str(self.gen) + " ********\n")
         fitnesses = []
         fitnessTotal = 0.0
@@ -102,17 +222,20 @@ class MarkovPopulation:
                     new_brains.append(sorted_pairs[count][0])
                     new_brains_fitnesses.append(fitnesses[count])
                 count += 1
+        if publish is not None:
+            for brain in new_brains:
+                publish(brain)
                 
 
         best_brain = sorted_pairs[0][0]
-        
+        best_gates = best_brain.brain(self.brainSize, self.brain_steps).gates
 
         if (self.fitness_sharing == False):
-            print("   Best brain ID: " + str(best_brain.ID) + "  ||  Fitness: " + str(best_brain.fitness) + "\n  ||  # Gates: " + str(len(best_brain.gates)) + "  ||  Genome Length: " + str(best_brain.genome.length) + "\n")
+            print("   Best brain ID: " + str(best_brain.ID) + "  ||  Fitness: " + str(best_brain.fitness) + "\n  ||  # Gates: " + str(len(best_gates)) + "  ||  Genome Length: " + str(best_brain.genome.length) + "\n")
         else:
-            print("   Best brain ID: " + str(best_brain.ID) + "  ||  Fitness: " + str(best_brain.fitness) + "  ||  Normalized Fitness: " + str(best_brain.normalized_fitness) + "\n  ||  # Gates: " + str(len(best_brain.gates)) + "  ||  Genome Length: " + str(best_brain.genome.length) + "\n")
+            print("   Best brain ID: " + str(best_brain.ID) + "  ||  Fitness: " + str(best_brain.fitness) + "  ||  Normalized Fitness: " + str(best_brain.normalized_fitness) + "\n  ||  # Gates: " + str(len(best_gates)) + "  ||  Genome Length: " + str(best_brain.genome.length) + "\n")
         gatestring = []
-        for gate in best_brain.gates:
+        for gate in best_gates:
             gatestring.append(gate.type)
         gatestring = str(gatestring)
         print("   Gate Types: " + gatestring + "\n")
@@ -151,65 +274,122 @@ class MarkovPopulation:
                 k += 1
 
                 
-            genome_copy = Genome(sorted_pairs[j][0].genome.length)    #Genome of parent 1
-            genome_copy2 = Genome(sorted_pairs[k][0].genome.length)  #Genome of parent 2
-            sequence_copy = []
-            sequence_copy2 = []
-            for value in sorted_pairs[j][0].genome.sequence:
-                sequence_copy.append(value)
-            for value in sorted_pairs[k][0].genome.sequence:
-                sequence_copy2.append(value)
-            genome_copy.sequence = sequence_copy
-            genome_copy2.sequence = sequence_copy2
-
-            #create child genome from parents'
-            index = random.randint(0, genome_copy.length - 1)
-            index2 = random.randint(0, genome_copy2.length - 1)
-
-            child_sequence = []
-
-            for y in range(math.floor(genome_copy.length / 2)):
-                child_sequence.append( genome_copy.sequence[ (index + y) % genome_copy.length ] )
-
-            for y in range(math.floor(genome_copy2.length / 2)):
-                child_sequence.append( genome_copy2.sequence[ (index2 + y) % genome_copy2.length ] )
-
-
-            child_genome = Genome(1) #temporarily initialized
-
-            e_spin = random.uniform(0, 1)
-            if e_spin < self.prob_engulf:   #If genome was engulfed, do this instead of crossover
-                child_genome = Genome( genome_copy.length + genome_copy2.length )
-                engulf_point = random.randint(0, genome_copy.length - 1)
-                for w in range(engulf_point):
-                    child_genome.sequence[w] = genome_copy.sequence[w]
-                for v in range(genome_copy2.length):
-                    child_genome.sequence[engulf_point + v] = genome_copy2.sequence[v]
-                for u in range(genome_copy.length - engulf_point):
-                    child_genome.sequence[engulf_point + genome_copy2.length + u] = genome_copy.sequence[engulf_point + u]
-            else:   #Use child obtained from normal crossover 
-                child_genome = Genome( len(child_sequence) )
-
-                for y in range(len(child_genome.sequence)):
-                    child_genome.sequence[y] = child_sequence[y] 
-
-            #mutate genome
-            child_genome.mutate(self.point_mutation, self.insert_mutation, self.delete_mutation, self.copy_mutation, self.big_delete_mutation, self.big_copy_mutation)
+            child_genome = self.breed(sorted_pairs[j][0].genome, sorted_pairs[k][0].genome)
 
             #Add brain based on new genome to new popultaion
-            new_brains.append(MarkovBrain(self.brainSize, child_genome.length, self.brain_steps, self.idCounter, child_genome))
+            new_brains.append(Individual(self.idCounter, child_genome))
             self.idCounter = self.idCounter + 1
+            if publish is not None:
+                publish(new_brains[-1])
         #Generate a number of random individuals for diversity in the population
-        for x in range(self.diversity_generate):
-            new = MarkovBrain(self.brainSize, self.genome_length, self.brain_steps, self.idCounter)
+        diversity = list(randoms[:self.diversity_generate]) if randoms is not None else []
+        diversity += self.random_brains(self.diversity_generate - len(diversity))
+        for new in diversity:
             new_brains.append(new)
-            self.idCounter = self.idCounter + 1
+            if publish is not None:
+                publish(new)
 
         self.brains = new_brains
         random.shuffle(self.brains)
         self.gen = self.gen + 1
         print("\n*************** GENERATION STEP FINISH ********************\n\n")
 
+    #Island model: copies of the `count` fittest evaluated brains, as (genome, fitness, validation_fitness)
+    def migrants(self, count):
+        evaluated = [brain for brain in self.brains if brain.ID not in self.unevaluated]
+        best = list(reversed(sorted(evaluated, key=lambda brain: brain.fitness)))[:count]
+        return [(brain.genome, brain.fitness, brain.validation_fitness) for brain in best]
+
+    #Island model: take in migrants from other islands, each replacing the least fit evaluated brain
+    #  (unless the migrant is less fit than it). Their fitnesses are kept, so they are not re-evaluated.
+    def immigrate(self, arrivals):
+        for genome, fitness, validation_fitness in arrivals:
+            candidates = [brain for brain in self.brains if brain.ID not in self.unevaluated]
+            if len(candidates) == 0:
+                return
+            worst = min(candidates, key=lambda brain: brain.fitness)
+            if fitness < worst.fitness:
+                continue
+            brain = Individual(self.idCounter, genome)
+            self.idCounter = self.idCounter + 1
+            brain.fitness = fitness
+            brain.validation_fitness = validation_fitness
+            self.brains[self.brains.index(worst)] = brain
+
+    #Steady-state mode: instead of breeding whole generations with eval_genomes, ask() hands out one
+    #  brain at a time and tell() puts its fitness back, where it replaces a weak member of the
+    #  population right away, so there is no generation to wait for. The initial brains are handed
+    #  out first; after that every brain is the child of two tournament winners or, at the rate of
+    #  diversity_generate per popSize, a new random individual.
+
+    #Fittest of `size` evaluated brains picked at random
+    def tournament(self, brains, size):
+        return max(random.sample(brains, min(size, len(brains))), key=lambda brain: brain.fitness)
+
+    #The next brain to evaluate; report its fitness with tell(brain.ID, ...)
+    def ask(self, tournament_size = 3):
+        if self.untested is None:
+            self.untested = list(self.brains)
+            self.unevaluated = set(brain.ID for brain in self.brains)
+        if len(self.untested) > 0:
+            brain = self.untested.pop(0)
+        else:
+            evaluated = [brain for brain in self.brains if brain.ID not in self.unevaluated]
+            if len(evaluated) < 2 or random.uniform(0, 1) < self.diversity_generate / float(self.popSize):
+                brain = self.random_brains(1)[0]
+            else:
+                child_genome = self.breed(self.tournament(evaluated, tournament_size).genome, self.tournament(evaluated, tournament_size).genome)
+                brain = Individual(self.idCounter, child_genome)
+                self.idCounter = self.idCounter + 1
+        self.asked[brain.ID] = brain
+        return brain
+
+    #Record the fitness of a brain returned by ask(). A new brain replaces the least fit of the
+    #  evaluated population (replacement = 'worst') or of `tournament_size` of them picked at random
+    #  (replacement = 'tournament'), unless it is less fit than that member.
+    def tell(self, ID, fitness, validation_fitness = 0.0, replacement = 'worst', tournament_size = 3):
+        brain = self.asked.pop(ID)
+        brain.fitness = fitness
+        brain.validation_fitness = validation_fitness
+        self.told = self.told + 1
+
+        if ID in self.unevaluated:   #one of the initial brains, already in the population
+            self.unevaluated.discard(ID)
+        else:
+            candidates = [member for member in self.brains if member.ID not in self.unevaluated]
+            if replacement == 'tournament':
+                candidates = random.sample(candidates, min(tournament_size, len(candidates)))
+            if len(candidates) > 0:
+                worst = min(candidates, key=lambda member: member.fitness)
+                if brain.fitness >= worst.fitness:
+                    self.brains[self.brains.index(worst)] = brain
+
+        #Report every popSize evaluations, the steady-state equivalent of a generation
+        if self.told % self.popSize == 0:
+            evaluated = [member for member in self.brains if member.ID not in self.unevaluated]
+            best_brain = max(evaluated, key=lambda member: member.fitness)
+            print("\n****** MARKOV PYTHON ||||| STEADY STATE, " + str(self.told) + " EVALUATIONS ********\n")
+            print("   Best brain ID: " + str(best_brain.ID) + "  ||  Fitness: " + str(best_brain.fitness) + "\n  ||  # Gates: " + str(len(best_brain.brain(self.brainSize, self.brain_steps).gates)) + "  ||  Genome Length: " + str(best_brain.genome.length) + "\n")
+            print("   Average Fitness: " + str(sum(member.fitness for member in evaluated) / float(len(evaluated))) + "\n")
+            self.gen = self.gen + 1
+
+#A member of the population as the GA sees it: an ID, a genome and its fitnesses. The master only
+#  selects and breeds, so it never needs the gates; brain() builds the MarkovBrain that runs the genome.
+class Individual:
+    def __init__(self, ID, genome):
+        self.ID = ID
+        self.genome = genome
+        self.fitness = 0.0
+        self.validation_fitness = 0.0
+        self.normalized_fitness = 0.0
+
+    def brain(self, size, brain_steps):
+        brain = MarkovBrain(size, self.genome.length, brain_steps, self.ID, self.genome)
+        brain.fitness = self.fitness
+        brain.validation_fitness = self.validation_fitness
+        brain.normalized_fitness = self.normalized_fitness
+        return brain
+
 class MarkovBrain:
     def __init__(self, size, genome_length, brain_steps, ID, genome_ready = None):
         self.ID = ID
@@ -217,9 +397,7 @@ class MarkovBrain:
         if genome_ready is None:
             self.genome = Genome(genome_length)
         else:
-            self.genome = Genome(genome_length)
-            for x in range(len(self.genome.sequence)):
-                self.genome.sequence[x] = genome_ready.sequence[x]
+            self.genome = Genome.from_bytes(genome_ready.genes[:genome_length])
         self.brainState = []
         self.newBrainState = []
         self.brainFlags = []
@@ -232,195 +410,37 @@ class MarkovBrain:
             self.brainState.append(0)
             self.brainFlags.append(0)
             self.newBrainState.append(0)
-        self.gates = []
-        for y in range(genome_length):
-            #deterministic logic gate
-            if self.genome.sequence[y] == 42 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 213:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-
-                tableValues = []
-                for x in range(2**numInputs):
-                    bString = ('{0:04b}'.format(self.genome.sequence[(y + 12 + x) % len(self.genome.sequence)]))
-
-                    value = []
-                    for z in range(numOutputs):
-                        value.append(int(bString[len(bString) - 1 - z]))
-
-                    tableValues.append(value)
-                
-                self.gates.append(DeterministicGate( numInputs, numOutputs, inputIndices, outputIndices, tableValues))
-            #probabilistic logic gate
-            elif self.genome.sequence[y] == 43 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 212:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-
-                tableValues = []
-                for x in range(2**numInputs):
-                    row = []
-                    for z in range(2**numOutputs):
-                        row.append(self.genome.sequence[(y + 12 + x) % len(self.genome.sequence)])
-                    tableValues.append(row)
-                #Normalize table values so that probabilities in each row sum to one
-                for x in range(2**numInputs):
-                    denom = 0
-                    for z in range(2**numOutputs):
-                        denom += (1 + tableValues[x][z])
-                    for z in range(2**numOutputs):
-                        tableValues[x][z] = (tableValues[x][z] + 1)/denom
-                      
-                self.gates.append(ProbabilisticGate( numInputs, numOutputs, inputIndices, outputIndices, tableValues))
-            #threshold gate
-            elif self.genome.sequence[y] == 44 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 211:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
+        self._gates = None
+        self.program = None
 
-                
-                threshold = (self.genome.sequence[(y + 12) % len(self.genome.sequence)]) % THRESHOLD_CONSTANT
-                
-                self.gates.append(ThresholdGate( numInputs, numOutputs, inputIndices, outputIndices, threshold))
-            #timer gate
-            elif self.genome.sequence[y] == 45 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 210:  
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
+    #Decoded from the genome the first time they are needed
+    @property
+    def gates(self):
+        if self._gates is None:
+            self._gates = decode_gates(self.genome.sequence, self.size)
+        return self._gates
 
-        
-                timer = (self.genome.sequence[(y + 12) % len(self.genome.sequence)]) % TIMER_CONSTANT
-                
-                self.gates.append(TimerGate(numOutputs, outputIndices, timer))
-            #ternary logic gate
-            elif self.genome.sequence[y] == 46 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 209:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-
-                tableValues = []
-                for x in range(3**numInputs):
-                    tString = ternary(self.genome.sequence[(y + 12 + x) % len(self.genome.sequence)])
-
-                    tString = list(tString)
-
-                    while len(tString) < numOutputs:
-                        tString = [0] + tString
-                    
-
-                    value = []
-                    #change ternary values from (0, 2) range to (-1, 1) range
-                    for z in range(numOutputs):
-                        value.append(int(tString[len(tString) - 1 - z]) - 1)
-
-                    
-                    tableValues.append(value)
-                
-                self.gates.append(TernaryGate( numInputs, numOutputs, inputIndices, outputIndices, tableValues))
-            #Artificial Neuron gate
-            elif self.genome.sequence[y] == 47 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 208:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
+    @gates.setter
+    def gates(self, gates):
+        self._gates = gates
 
-                numNeurons = (self.genome.sequence[(y + 12) % len(self.genome.sequence)] % 4) + 1
 
-                weights = []
-                for x in range((numInputs + 1) * (numNeurons)):
-                    weights.append( (self.genome.sequence[(y + 13 + x) % len(self.genome.sequence)] - 128.0)/100.0 )
+    #Compile the gates into a BrainProgram, which activate() runs from then on instead of the gate
+    #  objects, with the same results. The program takes over the threshold and timer gates' counts
+    #  as they are now.
+    def compile(self):
+        self.program = BrainProgram(self.gates, self.size)
+        return self.program
 
-                
-                self.gates.append(NNGate( numInputs, numOutputs, inputIndices, outputIndices, numNeurons, weights))
-            #Stats Gate (min max or average)
-            elif self.genome.sequence[y] == 48 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 207:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-
-                operation = self.genome.sequence[(y + 12) % len(self.genome.sequence)] % 3
-                
-                self.gates.append(StatsGate( numInputs, numOutputs, inputIndices, outputIndices, operation))
-            
-            #Sum Gate
-            elif self.genome.sequence[y] == 49 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 206:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-                
-                self.gates.append(SumGate( numInputs, numOutputs, inputIndices, outputIndices))
-            
-            #NULL gate
-            elif self.genome.sequence[y] == 50 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 205:  
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-               
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-                
-                self.gates.append(NullGate(numOutputs, outputIndices))
-            
-            #Invert Gate
-            elif self.genome.sequence[y] == 51 and self.genome.sequence[(y + 1) % len(self.genome.sequence)] == 204:  
-                numInputs = (self.genome.sequence[(y + 2) % len(self.genome.sequence)] % 4) + 1
-                numOutputs = (self.genome.sequence[(y + 3) % len(self.genome.sequence)] % 4) + 1
-                inputIndices = []
-                for x in range(numInputs):
-                    inputIndices.append(self.genome.sequence[(y + 4 + x) % len(self.genome.sequence)] % self.size)
-
-                outputIndices = []
-                for x in range(numOutputs):
-                    outputIndices.append(self.genome.sequence[(y + 8 + x) % len(self.genome.sequence)] % self.size)
-
-                operation = self.genome.sequence[(y + 12) % len(self.genome.sequence)] % 2
-                
-                self.gates.append(InvertGate( numInputs, numOutputs, inputIndices, outputIndices, operation))
-            
-
-                
     def activate(self, inputs):
+        if self.program is not None:
+            for a in range(self.brain_steps):
+                for x in range(len(inputs)):
+                    self.brainState[x] = inputs[x]
+                self.program.run(self.brainState, self.brainFlags)
+            self.newBrainState = self.brainState
+            return
+
         for a in range(self.brain_steps):   # steps of thinking per action
             for value in self.brainFlags:
                 value = 0
@@ -441,12 +461,45 @@ class MarkovBrain:
 
             self.brainState = self.newBrainState
      
+#The positions, among the first `count`, where a trial of probability `rate` succeeds: instead of a
+#  draw per position, draws the gap to the next success (geometric distribution)
+def mutation_sites(rate, count):
+    if rate <= 0:
+        return []
+    if rate >= 1:
+        return list(range(count))
+    sites = []
+    logFailure = math.log(1.0 - rate)
+    y = -1
+    while True:
+        y += 1 + int(math.log(1.0 - random.random()) / logFailure)
+        if y >= count:
+            return sites
+        sites.append(y)
+
+#The genes are kept in a bytearray (one byte per gene, as genes are 0-255), so copies are plain
+#  memory copies. `sequence` is the same bytearray, which indexes, slices, iterates, inserts and
+#  deletes like the list of ints it used to be; assigning any sequence of 0-255 ints to it works too.
 class Genome:
     def __init__(self, length):
-        self.length = length
-        self.sequence = []
-        for x in range(self.length):
-            self.sequence.append(random.randint(0, 255))
+        self.genes = bytearray(random.getrandbits(8 * length).to_bytes(length, 'little')) if length > 0 else bytearray()
+
+    @property
+    def sequence(self):
+        return self.genes
+
+    @sequence.setter
+    def sequence(self, values):
+        self.genes = bytearray(values)
+
+    @property
+    def length(self):
+        return len(self.genes)
+
+    #Old callers set length to len(sequence) after changing the sequence; the length now always follows the genes
+    @length.setter
+    def length(self, value):
+        pass
 
     def mutate(self, point_mutation, insert_mutation, delete_mutation, copy_mutation, big_delete_mutation, big_copy_mutation):
         #big delete mutation (1000 min length of genome necessary)
@@ -454,45 +507,115 @@ class Genome:
             delete_length = random.randint(256, 512)
             delete_index = random.randint(0, len(self.sequence) - 1)
 
-            for x in range(delete_length):
-                self.sequence[delete_index] = -1
-                delete_index = (delete_index + 1) % len(self.sequence)
-
-            obj = -1
-            for x in range(delete_length):
-                self.sequence.remove(obj)
+            #the deleted stretch may wrap around the end
+            length = len(self.sequence)
+            end = delete_index + delete_length
+            del self.sequence[delete_index:end]
+            if end > length:
+                del self.sequence[:end - length]
             
-        #big copy mutation(20,000 max length of genome)
+        #big copy mutation(20,000 max length of genome): a stretch of genes (wrapping around the end,
+        #  if need be) is copied and the copy inserted right after the stretch itself
         if len(self.sequence) < MAX_GENOME_CONSTANT and random.uniform(0, 1) <= big_copy_mutation:
             copy_length = random.randint(256, 512)
             copy_index = random.randint(0, len(self.sequence) - 1)
-            copied_genes = []
-            for x in range(copy_length):
-                copied_genes.append(self.sequence[copy_index])
-                copy_index = (copy_index + 1) % len(self.sequence)
-
-            for x in range(copy_length):
-                self.sequence.insert(copy_index, copied_genes[x])
-                copy_index = (copy_index + 1) % len(self.sequence)
-                
-        #all single-point mutations
-        for y in range(len(self.sequence)):
-            #point mutation
-            if random.uniform(0, 1) <= point_mutation and y < len(self.sequence):
-                self.sequence[y] = random.randint(0, 255)
-            #insert mutation
-            if len(self.sequence) < MAX_GENOME_CONSTANT and random.uniform(0, 1) <= insert_mutation and y < len(self.sequence):
-                self.sequence.insert(y, random.randint(0, 255))
-            #delete mutation
-            if len(self.sequence) > 1000 and random.uniform(0, 1) <= delete_mutation and y < len(self.sequence):
-                obj = -1
-                self.sequence[y] = -1
-                self.sequence.remove(obj)
-            #copy mutation
-            if len(self.sequence) < MAX_GENOME_CONSTANT and random.uniform(0, 1) <= copy_mutation and y < len(self.sequence):
-                self.sequence.insert(y, self.sequence[y])
-
-        self.length = len(self.sequence)
+            length = len(self.sequence)
+            copied_genes = (self.sequence[copy_index:] + self.sequence * (copy_length // length + 1))[:copy_length]
+            copy_index = (copy_index + copy_length) % length
+            self.sequence[copy_index:copy_index] = copied_genes
+
+        #all single-point mutations. Each position y of the genome gets a point, insert, delete and copy
+        #  trial, in that order, applied at index y of the genome as it stands at that point (so a gene
+        #  inserted at y pushes the gene that was there to y + 1, which is tried again). Only the
+        #  positions where a trial succeeds are drawn, and the genome is rebuilt in one pass: genes before
+        #  index y are final, `pending` holds genes inserted at y that are not final yet, and the rest
+        #  is still the unchanged genome from source[j:].
+        source = self.genes
+        count = len(source)
+        events = sorted([(y, 0) for y in mutation_sites(point_mutation, count)] + [(y, 1) for y in mutation_sites(insert_mutation, count)]
+                        + [(y, 2) for y in mutation_sites(delete_mutation, count)] + [(y, 3) for y in mutation_sites(copy_mutation, count)])
+        genes = bytearray()
+        pending = deque()
+        j = 0
+        for y, operation in events:
+            #Positions before y go through untouched
+            while len(genes) < y and len(pending) > 0:
+                genes.append(pending.popleft())
+            if len(genes) < y:
+                step = min(y - len(genes), count - j)
+                genes += source[j:j + step]
+                j += step
+            length = len(genes) + len(pending) + count - j
+            if y >= length:   #the genome got shorter than y; nothing further applies
+                break
+            current = pending[0] if len(pending) > 0 else source[j]
+            if operation == 0:     #point mutation
+                if len(pending) > 0:
+                    pending[0] = random.randint(0, 255)
+                else:
+                    pending.append(random.randint(0, 255))
+                    j += 1
+            elif operation == 1:   #insert mutation
+                if length < MAX_GENOME_CONSTANT:
+                    pending.appendleft(random.randint(0, 255))
+            elif operation == 2:   #delete mutation
+                if length > 1000:
+                    if len(pending) > 0:
+                        pending.popleft()
+                    else:
+                        j += 1
+            else:                  #copy mutation
+                if length < MAX_GENOME_CONSTANT:
+                    pending.appendleft(current)
+        genes += bytes(pending)
+        genes += source[j:]
+        self.genes = genes
+
+    #The genes as raw bytes (one byte per gene)
+    def to_bytes(self):
+        return bytes(self.genes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        genome = cls(0)
+        genome.genes = bytearray(data)
+        return genome
+
+    #Content hash of the genes; identical genomes always share the same hash
+    def content_hash(self):
+        return hashlib.blake2b(self.genes, digest_size = 16).hexdigest()
+
+    #Encode the genome as a single string: "G1r:" (raw) or "G1z:" (zlib) followed by base64 bytes
+    def encode(self, compress = False):
+        data = self.to_bytes()
+        if compress:
+            return "G" + str(GENOME_ENCODING_VERSION) + "z:" + base64.b64encode(zlib.compress(data)).decode('ascii')
+        return "G" + str(GENOME_ENCODING_VERSION) + "r:" + base64.b64encode(data).decode('ascii')
+
+    #Encode the genome split into pieces of at most cellLimit characters, one per sheet cell
+    def encode_cells(self, compress = False, cellLimit = CELL_CHARACTER_LIMIT):
+        text = self.encode(compress)
+        return [text[x:x + cellLimit] for x in range(0, len(text), cellLimit)]
+
+    #Build a genome from a string made by encode(). The old comma-separated decimal format is still accepted.
+    @classmethod
+    def decode(cls, text):
+        if not text.startswith("G"):
+            return cls.from_bytes([int(value) for value in text.split(",") if value != ""])
+        header, payload = text.split(":", 1)
+        if header[1:-1] != str(GENOME_ENCODING_VERSION):
+            raise ValueError("Unknown genome encoding version: " + header)
+        data = base64.b64decode(payload)
+        if header[-1] == "z":
+            data = zlib.decompress(data)
+        elif header[-1] != "r":
+            raise ValueError("Unknown genome encoding: " + header)
+        return cls.from_bytes(data)
+
+    #Build a genome from the cells written by encode_cells()
+    @classmethod
+    def decode_cells(cls, cells):
+        return cls.decode("".join(cells))
 
 class DeterministicGate:
     def __init__(self, numInputs, numOutputs, inputIndices, outputIndices, tableValues ):
@@ -821,3 +944,130 @@ class InvertGate:
                 brainFlags[self.outputIndices[x]] = 1
             else:
                 newBrainState[self.outputIndices[x]] = output[x] + newBrainState[self.outputIndices[x]]
+
+
+#A brain's gates compiled into one Python function, which MarkovBrain.activate runs instead of the
+#  gate objects once the brain is compiled (see MarkovBrain.compile). Each gate becomes a few lines
+#  of straight-line code with its nodes, table index place values and neuron weights written in as
+#  constants; truth tables are kept in `tables` and the counts of threshold and timer gates in
+#  `counters`. The gates run in genome order on the one state, doing exactly what
+#  their activate() does, so a compiled brain computes the same values (and draws the same random
+#  numbers) as the gate objects; it just skips building the inputs and outputs lists of every gate.
+#  `source` holds the code, which is also a readable listing of what the brain does.
+class BrainProgram:
+    def __init__(self, gates, size):
+        self.size = size
+        self.counters = []
+        self.tables = []
+        lines = []
+        for gate in gates:
+            lines += self._gate_source(gate)
+        self.source = "def step(s, f, c):\n" + "".join("    " + line + "\n" for line in lines or ["pass"])
+        namespace = {'tanh': math.tanh, 'uniform': random.uniform, 'roll_output': roll_output, 'tables': self.tables}
+        exec(compile(self.source, "<brain program>", "exec"), namespace)
+        self.step = namespace['step']
+
+    #Run one step of the brain on its state and flags (as MarkovBrain keeps them), in place
+    def run(self, brainState, brainFlags):
+        self.step(brainState, brainFlags, self.counters)
+
+    def _table(self, values):
+        self.tables.append([tuple(row) for row in values])
+        return "tables[" + str(len(self.tables) - 1) + "]"
+
+    def _counter(self, value):
+        self.counters.append(value)
+        return "c[" + str(len(self.counters) - 1) + "]"
+
+    #The code of one gate, as a list of lines
+    def _gate_source(self, gate):
+        lines = ["#" + gate.type + " gate"]
+        inputs = ["s[" + str(node) + "]" for node in gate.inputIndices[:gate.numInputs]] if gate.type not in ("T", "Nu") else []
+        outputs = gate.outputIndices[:gate.numOutputs]
+        if gate.type in ("D", "P"):
+            #The first input is the most significant bit of the table index
+            index = " + ".join("(" + str(2**(len(inputs) - 1 - x)) + " if " + inputs[x] + " > 0 else 0)" for x in range(len(inputs)))
+            if gate.type == "D":
+                lines.append("output = " + self._table(gate.tableValues) + "[" + index + "]")
+                lines += summed_writes(outputs, ["output[" + str(x) + "]" for x in range(len(outputs))])
+            else:
+                lines.append("outputNum = roll_output(" + self._table(probability_sums(gate.tableValues)) + "[" + index + "], uniform(0, 1))")
+                lines += summed_writes(outputs, ["((outputNum >> " + str(3 - x) + ") & 1)" for x in range(len(outputs))])
+        elif gate.type == "Ter":
+            index = " + ".join("(" + str(2 * 3**(len(inputs) - 1 - x)) + " if " + inputs[x] + " >= 1 else (0 if " + inputs[x] + " <= -1 else " + str(3**(len(inputs) - 1 - x)) + "))" for x in range(len(inputs)))
+            lines.append("output = " + self._table(gate.tableValues) + "[" + index + "]")
+            lines += summed_writes(outputs, ["output[" + str(x) + "]" for x in range(len(outputs))])
+        elif gate.type == "N":
+            #The neurons all use the first weights and the last as bias, so they all give the same activation
+            activation = "0" + "".join(" + " + inputs[x] + " * " + repr(gate.weights[x]) for x in range(len(inputs)))
+            lines.append("activation = tanh(" + activation + " + " + repr(gate.weights[len(gate.weights) - 1]) + ")")
+            lines.append("output = 0" + " + activation" * gate.numNeurons)
+            lines += summed_writes(outputs, ["output"] * len(outputs))
+        elif gate.type == "Th":
+            accumulator = self._counter(gate.accumulator)
+            lines.append(accumulator + " = " + accumulator + " + " + " + ".join("(1 if " + value + " > 0 else 0)" for value in inputs))
+            lines.append("if " + accumulator + " > " + str(gate.threshold) + ":")
+            for node in outputs:
+                target = "s[" + str(node) + "]"
+                flag = "f[" + str(node) + "]"
+                lines += ["    " + target + " = 1 if " + flag + " == 0 else " + target + " + 1", "    " + flag + " = 1"]
+            lines.append("    " + accumulator + " = 0")
+        elif gate.type == "T":
+            updates = self._counter(gate.updates)
+            lines.append(updates + " += 1")
+            lines.append("if " + updates + " > " + str(gate.timer) + ":")
+            for node in outputs:
+                target = "s[" + str(node) + "]"
+                flag = "f[" + str(node) + "]"
+                lines += ["    " + target + " = 1 if " + flag + " == 0 or " + target + " == 0 else " + target, "    " + flag + " = 1"]
+            lines.append("    " + updates + " = 0")
+        elif gate.type == "S":
+            operation = ("min", "max", "sum")[gate.operation]
+            lines.append("output = " + operation + "([" + ", ".join(inputs) + "])" + (" / " + str(len(inputs)) if gate.operation == 2 else ""))
+            lines += summed_writes(outputs, ["output"] * len(outputs))
+        elif gate.type == "Sum":
+            lines.append("output = sum([" + ", ".join(inputs) + "])")
+            lines += summed_writes(outputs, ["output"] * len(outputs))
+        elif gate.type == "Nu":
+            for node in outputs:
+                lines += ["s[" + str(node) + "] = 0", "f[" + str(node) + "] = 0"]
+        else:               #invert gate, one output per input
+            lines.append("inputs = [" + ", ".join(inputs) + "]")
+            if gate.operation == 0:
+                values = ["inputs[" + str(x) + "] * -1.0" for x in range(len(inputs))]
+            else:
+                values = ["(1.0/inputs[" + str(x) + "] if inputs[" + str(x) + "] > 0.001 or inputs[" + str(x) + "] < -0.001 else 1.0)" for x in range(len(inputs))]
+            lines += summed_writes(gate.outputIndices[:gate.numInputs], values)
+        return lines
+
+
+#Lines writing `values` to the `outputs` nodes the way the gates do: the first write to a node
+#  without its flag sets it, later ones are summed
+def summed_writes(outputs, values):
+    lines = []
+    for node, value in zip(outputs, values):
+        target = "s[" + str(node) + "]"
+        flag = "f[" + str(node) + "]"
+        lines += [target + " = " + value + " if " + flag + " == 0 else " + value + " + " + target, flag + " = 1"]
+    return lines
+
+#For each row of a probabilistic gate's table, the running sums its roll is compared against,
+#  added up as ProbabilisticGate.activate adds them
+def probability_sums(tableValues):
+    sums = []
+    for row in tableValues:
+        rowSums = []
+        for x in range(len(row)):
+            probSum = 0
+            for y in range(x):
+                probSum += row[y]
+            rowSums.append(probSum + row[x])
+        sums.append(rowSums)
+    return sums
+
+#The output number a probabilistic gate picks with `roll`
+def roll_output(probSums, roll):
+    for x in range(len(probSums)):
+        if roll < probSums[x]:
+            return x
+    return 0
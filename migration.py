@@ -0,0 +1,142 @@
+"""
+Migration channels for the island model.
+
+Several masters (islands) each evolve their own population with their own slaves,
+and every few generations each island sends copies of its best genomes to the others.
+A channel is where an island posts its latest migrants and picks up the migrants of
+the other islands. Each island owns a single slot that it overwrites, so a channel
+never grows, and an island that falls behind only misses older migrants.
+
+DirectoryChannel shares the slots as files in a directory (a shared drive works too),
+SheetsChannel as a block of cells of a Google Sheet that every island can reach.
+A migrant travels as (encoded genome, fitness, validation_fitness); fitnesses are only
+comparable between islands evaluating the same problem (the same EVAL_CONFIG).
+"""
+
+import json
+import os
+import time
+import zlib
+
+import markov
+from sheets_io import RequestBatch
+
+
+#Interface shared by every channel
+class MigrationChannel:
+    #Post this island's migrants, a list of (genome, fitness, validation_fitness), replacing the previous ones
+    def emigrate(self, migrants):
+        raise NotImplementedError
+
+    #The migrants other islands posted since the last call, as (genome, fitness, validation_fitness)
+    def immigrants(self):
+        raise NotImplementedError
+
+
+#Each island writes its slot to "island_<n>.json" in `path`
+class DirectoryChannel(MigrationChannel):
+    def __init__(self, path, island):
+        self.path = path
+        self.island = island
+        self.sequence = 0   #of this island's last post; a timestamp in ms, so it keeps growing across restarts
+        self.seen = {}      #island -> sequence number of the last post taken from it
+        os.makedirs(path, exist_ok = True)
+
+    def _file(self, island):
+        return os.path.join(self.path, "island_" + str(island) + ".json")
+
+    def emigrate(self, migrants):
+        self.sequence = max(self.sequence + 1, int(time.time() * 1000))
+        post = {
+            'island': self.island,
+            'sequence': self.sequence,
+            'migrants': [[genome.encode(True), fitness, validation_fitness] for genome, fitness, validation_fitness in migrants]
+        }
+        #Readers must never see half a file
+        temp = self._file(self.island) + "." + str(os.getpid()) + ".tmp"
+        with open(temp, 'w') as postFile:
+            json.dump(post, postFile)
+        os.replace(temp, self._file(self.island))
+
+    def immigrants(self):
+        arrivals = []
+        for name in sorted(os.listdir(self.path)):
+            if not (name.startswith("island_") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as postFile:
+                    post = json.load(postFile)
+            except (OSError, ValueError):
+                continue
+            if post['island'] == self.island or post['sequence'] <= self.seen.get(post['island'], 0):
+                continue
+            self.seen[post['island']] = post['sequence']
+            for text, fitness, validation_fitness in post['migrants']:
+                arrivals.append((markov.Genome.decode(text), fitness, validation_fitness))
+        return arrivals
+
+
+#The slots as rows of a Google Sheet, starting at column MIGRATION_FIRST_COLUMN (clear of the columns
+#  SheetsTransport uses, so the sheet of one of the islands can host the channel). Island n owns
+#  `slots` rows starting at row n * slots + 1, one migrant per row: the first cell holds
+#  "island|sequence|fitness|validation|hash" and the next ones the genome's encoded cells. Rows are
+#  written across the full width so no cell of a longer, older migrant is left behind, and a migrant
+#  whose genome doesn't match its hash (cells of two posts) is left out.
+MIGRATION_FIRST_COLUMN = 'P'
+MIGRATION_LAST_COLUMN = 'U'
+MIGRATION_WIDTH = ord(MIGRATION_LAST_COLUMN) - ord(MIGRATION_FIRST_COLUMN) + 1
+
+class SheetsChannel(MigrationChannel):
+    def __init__(self, service, sheetID, island, islands, client, slots = 10):
+        self.values = service.spreadsheets().values()
+        self.sheetID = sheetID
+        self.island = island
+        self.islands = islands
+        self.client = client    #an api_client.ApiClient
+        self.slots = slots
+        self.sequence = 0
+        self.seen = {}      #island -> sequence number of the last post taken from it
+
+    def _execute(self, request, write = False):
+        return self.client.execute(request, write)
+
+    def _range(self, first, last):
+        return MIGRATION_FIRST_COLUMN + str(first) + ":" + MIGRATION_LAST_COLUMN + str(last)
+
+    def emigrate(self, migrants):
+        self.sequence = max(self.sequence + 1, int(time.time() * 1000))
+        rows = []
+        for genome, fitness, validation_fitness in migrants[:self.slots]:
+            header = "|".join([str(self.island), str(self.sequence), str(fitness), str(validation_fitness), genome.content_hash()])
+            rows.append([header] + genome.encode_cells(True))
+        #Unused slots are blanked so they don't read as part of this post
+        while len(rows) < self.slots:
+            rows.append([])
+        rows = [row + [""] * (MIGRATION_WIDTH - len(row)) for row in rows]
+        first = self.island * self.slots + 1
+        with RequestBatch(self.values, self.sheetID, self._execute) as batch:
+            batch.update(self._range(first, first + self.slots - 1), rows)
+
+    def immigrants(self):
+        with RequestBatch(self.values, self.sheetID, self._execute) as batch:
+            read = batch.get(self._range(1, self.islands * self.slots))
+        posts = {}
+        for row in read.values or []:
+            header = row[0].split("|") if len(row) > 1 else []
+            if len(header) != 5:
+                continue
+            island, sequence = int(header[0]), int(header[1])
+            if island == self.island or sequence <= self.seen.get(island, 0):
+                continue
+            try:
+                genome = markov.Genome.decode_cells(row[1:])
+            except (ValueError, zlib.error):
+                continue
+            if genome.content_hash() != header[4]:
+                continue
+            posts.setdefault((island, sequence), []).append((genome, float(header[2]), float(header[3])))
+        arrivals = []
+        for (island, sequence) in sorted(posts):
+            self.seen[island] = max(sequence, self.seen.get(island, 0))
+            arrivals += posts[(island, sequence)]
+        return arrivals
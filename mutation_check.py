@@ -0,0 +1,118 @@
+"""
+Checks Genome.mutate against the operator it replaced, which made a random draw for every
+position of the genome and edited a list of genes in place. The two don't draw the same random
+numbers, so their results are compared as distributions over many seeds: for each operator on
+its own, the number of sites it changed (genes rewritten for point mutations, genes gained or
+lost for the others), and for all of them together, the length of the mutated genome. Each pair
+of distributions has to pass a two-sample Kolmogorov-Smirnov test and have close means.
+
+Run it with no arguments: python mutation_check.py
+"""
+
+import math
+import random
+
+import markov
+
+
+#The mutate of the original Genome, kept as the reference (on a list of genes)
+def reference_mutate(sequence, point_mutation, insert_mutation, delete_mutation, copy_mutation, big_delete_mutation, big_copy_mutation):
+    #big delete mutation (1000 min length of genome necessary)
+    if len(sequence) >= 1000 and random.uniform(0, 1) <= big_delete_mutation:
+        delete_length = random.randint(256, 512)
+        delete_index = random.randint(0, len(sequence) - 1)
+        for x in range(delete_length):
+            sequence[delete_index] = -1
+            delete_index = (delete_index + 1) % len(sequence)
+        for x in range(delete_length):
+            sequence.remove(-1)
+
+    #big copy mutation
+    if len(sequence) < markov.MAX_GENOME_CONSTANT and random.uniform(0, 1) <= big_copy_mutation:
+        copy_length = random.randint(256, 512)
+        copy_index = random.randint(0, len(sequence) - 1)
+        copied_genes = []
+        for x in range(copy_length):
+            copied_genes.append(sequence[copy_index])
+            copy_index = (copy_index + 1) % len(sequence)
+        for x in range(copy_length):
+            sequence.insert(copy_index, copied_genes[x])
+            copy_index = (copy_index + 1) % len(sequence)
+
+    #all single-point mutations
+    for y in range(len(sequence)):
+        if random.uniform(0, 1) <= point_mutation and y < len(sequence):
+            sequence[y] = random.randint(0, 255)
+        if len(sequence) < markov.MAX_GENOME_CONSTANT and random.uniform(0, 1) <= insert_mutation and y < len(sequence):
+            sequence.insert(y, random.randint(0, 255))
+        if len(sequence) > 1000 and random.uniform(0, 1) <= delete_mutation and y < len(sequence):
+            sequence[y] = -1
+            sequence.remove(-1)
+        if len(sequence) < markov.MAX_GENOME_CONSTANT and random.uniform(0, 1) <= copy_mutation and y < len(sequence):
+            sequence.insert(y, sequence[y])
+    return sequence
+
+
+#The operators checked one at a time: name, rates as passed to mutate, and what is counted
+#  ('changed': genes rewritten, 'length': genes gained or lost)
+OPERATORS = [
+    ("point", (0.01, 0, 0, 0, 0, 0), 'changed'),
+    ("insert", (0, 0.005, 0, 0, 0, 0), 'length'),
+    ("delete", (0, 0, 0.005, 0, 0, 0), 'length'),
+    ("copy", (0, 0, 0, 0.005, 0, 0), 'length'),
+    ("big delete", (0, 0, 0, 0, 0.5, 0), 'length'),
+    ("big copy", (0, 0, 0, 0, 0, 0.5), 'length'),
+    ("all together", (0.002, 0.002, 0.002, 0.002, 0.3, 0.3), 'length'),
+]
+
+
+def sites(before, after, measure):
+    if measure == 'changed':
+        return sum(1 for old, new in zip(before, after) if old != new)
+    return len(after) - len(before)
+
+
+#Largest distance between the empirical distribution functions of two samples
+def ks_statistic(first, second):
+    first = sorted(first)
+    second = sorted(second)
+    x = y = 0
+    distance = 0.0
+    while x < len(first) and y < len(second):
+        value = min(first[x], second[y])
+        while x < len(first) and first[x] == value:
+            x += 1
+        while y < len(second) and second[y] == value:
+            y += 1
+        distance = max(distance, abs(x / len(first) - y / len(second)))
+    return distance
+
+
+def check(name, rates, measure, seeds, length):
+    old = []
+    new = []
+    for seed in range(seeds):
+        random.seed(seed)
+        genes = [random.randint(0, 255) for x in range(length)]
+        old.append(sites(genes, reference_mutate(list(genes), *rates), measure))
+        genome = markov.Genome.from_bytes(genes)
+        genome.mutate(*rates)
+        new.append(sites(genes, list(genome.genes), measure))
+    distance = ks_statistic(old, new)
+    critical = 1.95 * math.sqrt(2.0 / seeds)   #1 in 1000 chance of failing on equal distributions
+    oldMean = sum(old) / float(seeds)
+    newMean = sum(new) / float(seeds)
+    spread = math.sqrt(sum((value - oldMean)**2 for value in old) / seeds) or 1.0
+    print("%-13s mean sites %9.2f (reference %9.2f)   KS %.3f (limit %.3f)" % (name, newMean, oldMean, distance, critical))
+    if distance > critical or abs(newMean - oldMean) > 4 * spread / math.sqrt(seeds) * math.sqrt(2):
+        raise AssertionError("Genome.mutate differs from the reference for " + name + " mutations")
+
+
+def run(seeds = 1000, length = 1500):
+    for name, rates, measure in OPERATORS:
+        check(name, rates, measure, seeds, length)
+    print("Genome.mutate matches the reference operator on " + str(seeds) + " seeds per operator")
+
+
+if __name__ == '__main__':
+    run()
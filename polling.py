@@ -0,0 +1,37 @@
+"""
+Polling policy shared by the master and slave loops.
+
+Waits start at a short floor and grow exponentially up to a ceiling while nothing
+happens, and drop back to the floor as soon as there is progress. Every wait is
+jittered so that many slaves started together don't keep polling in lock-step, and
+jittered waits are still kept under the ceiling. The jitter comes from a random.Random
+of the policy's own, so polling doesn't consume draws of the module-level generator the
+GA breeds with (and the master checkpoints).
+"""
+
+import random
+import time
+
+
+class PollingPolicy:
+    def __init__(self, floor = 1.0, ceiling = 30.0, factor = 2.0, jitter = 0.25, sleep = time.sleep, rng = None):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.factor = factor
+        self.jitter = jitter
+        self.sleep = sleep       #replaceable, e.g. by a fake clock
+        self.rng = rng if rng is not None else random.Random()
+        self.delay = floor
+
+    #Length of the next wait, and grow the one after it
+    def next_delay(self):
+        delay = min(self.ceiling, self.delay * self.rng.uniform(1.0 - self.jitter, 1.0 + self.jitter))
+        self.delay = min(self.ceiling, self.delay * self.factor)
+        return delay
+
+    def wait(self):
+        self.sleep(self.next_delay())
+
+    #Something happened: poll quickly again
+    def reset(self):
+        self.delay = self.floor
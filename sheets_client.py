@@ -0,0 +1,97 @@
+"""
+The one place the Google Sheets API service is created.
+
+get_service() authenticates (through token.pickle, or the browser flow the first time),
+builds the service once per process and hands the same object to every caller. The
+Google client libraries are imported only here and only when get_service() is first
+called, so processes using the local backend never load them. The discovery document
+is kept in a local file after the first download, so later starts build the service
+without fetching it, and all requests go through one HTTP connection that is kept open
+between calls. Code that talks to the API from several threads at once gives each thread
+its own service from build_service(), since a connection can't be shared between threads.
+"""
+
+import json
+import os
+import pickle
+
+
+#Read and write access to the user's spreadsheets
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE_PATH = 'sheets_v4_discovery.json'
+
+#Seconds before an HTTP request is abandoned (and retried by the ApiClient)
+HTTP_TIMEOUT = 60
+
+_service = None
+
+
+#Credentials from token.pickle, refreshed or obtained through the browser flow if needed
+def load_credentials(tokenPath = 'token.pickle', credentialsPath = 'credentials.json'):
+    from google.auth.transport.requests import Request
+
+    creds = None
+    # The file token.pickle stores the user's access and refresh tokens, and is
+    # created automatically when the authorization flow completes for the first
+    # time.
+    if os.path.exists(tokenPath):
+        with open(tokenPath, 'rb') as token:
+            creds = pickle.load(token)
+    # If there are no (valid) credentials available, let the user log in.
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(credentialsPath, SCOPES)
+            creds = flow.run_local_server()
+        # Save the credentials for the next run
+        with open(tokenPath, 'wb') as token:
+            pickle.dump(creds, token)
+    return creds
+
+
+#The discovery document, from the local copy if there is one; a fresh download replaces the copy
+def _discovery_document(http, cachePath):
+    if cachePath is not None and os.path.exists(cachePath):
+        with open(cachePath) as f:
+            return f.read()
+    response, content = http.request(DISCOVERY_URL)
+    if response.status != 200:
+        return None
+    document = content.decode('utf-8') if isinstance(content, bytes) else content
+    if cachePath is not None:
+        json.loads(document)   #don't cache an error page
+        temp = cachePath + '.' + str(os.getpid()) + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(document)
+        os.replace(temp, cachePath)
+    return document
+
+
+#The process-wide Sheets service, built on first use
+def get_service(tokenPath = 'token.pickle', credentialsPath = 'credentials.json', discoveryCachePath = DISCOVERY_CACHE_PATH):
+    global _service
+    if _service is None:
+        _service = build_service(tokenPath, credentialsPath, discoveryCachePath)
+    return _service
+
+
+#A new Sheets service with a connection of its own
+def build_service(tokenPath = 'token.pickle', credentialsPath = 'credentials.json', discoveryCachePath = DISCOVERY_CACHE_PATH):
+    import httplib2
+    import google_auth_httplib2
+    from googleapiclient.discovery import build, build_from_document
+
+    creds = load_credentials(tokenPath, credentialsPath)
+    #One Http object, so the connection to the API is reused from one request to the next
+    http = google_auth_httplib2.AuthorizedHttp(creds, http = httplib2.Http(timeout = HTTP_TIMEOUT))
+    try:
+        document = _discovery_document(httplib2.Http(timeout = HTTP_TIMEOUT), discoveryCachePath)
+    except (OSError, ValueError, httplib2.HttpLib2Error):
+        document = None
+    if document is not None:
+        return build_from_document(document, http = http)
+    return build('sheets', 'v4', http = http, cache_discovery = False)
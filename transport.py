@@ -0,0 +1,1467 @@
+"""
+Coordination backends for the distributed genetic algorithm.
+
+A transport is everything the master and slave processes share for one generation:
+the master publishes the population and waits for fitnesses, while the slaves claim
+batches of genomes, evaluate them and submit the fitnesses back.
+
+SheetsTransport is the original Google Sheets flow, and ShardedTransport spreads one
+population over several sheets (or tabs) with a SheetsTransport each. LocalTransport runs the same
+protocol through a SQLite file, for runs where every process is on one host
+(or for exercising the protocol with no network at all). SharedMemoryTransport is
+the fastest same-host option: the population sits in shared memory and slaves read
+it in place.
+
+Slaves don't own any fixed part of the population: each one repeatedly claims a
+small batch of whatever genomes are still unclaimed, so fast workers simply take
+more batches, and workers can join or leave at any time.
+
+Every generation is published under a new epoch number, and claims and results are
+tagged with the epoch they belong to. Anything left over from an older generation is
+simply ignored, so nothing ever needs to be cleared between generations.
+
+A claim is a lease: it expires leaseTime seconds after it was last renewed by the
+slave's heartbeat, and the genomes of an expired claim go back to the queue, so a
+slave that dies never stalls the generation. Near the end of a generation the master
+also reopens the genomes still outstanding, so an idle slave duplicates the work of
+the slowest ones; the genome keeps one of the results (the first, or on Google Sheets
+the last, which saves reading the rows before writing them).
+"""
+
+import concurrent.futures
+import hashlib
+import math
+import os
+import queue
+import random
+import socket
+import sqlite3
+import struct
+import time
+import zlib
+
+import markov
+from api_client import ApiClient
+from genome_store import GenomeStore
+from polling import PollingPolicy
+from sheets_io import RequestBatch
+
+
+#A name for this process that is unique across hosts, used to mark the genomes it claims. The
+#  suffix doesn't come from `random`: the master builds its transports after restoring the GA's
+#  random state from a checkpoint.
+def make_worker_id():
+    return socket.gethostname() + "-" + str(os.getpid()) + "-" + os.urandom(4).hex()
+
+
+#What a slave holds after claim_batch: the population indices it claimed (rows) and the
+#  token that marks them as its own
+class Claim:
+    def __init__(self, rows, token, claimedAt, epoch):
+        self.rows = rows
+        self.token = token
+        self.epoch = epoch    #the generation the rows belong to
+        self.claimedAt = claimedAt
+        self.renewedAt = claimedAt
+
+
+#Small description of the generation currently published, cheap enough for slaves to poll
+class Metadata:
+    def __init__(self, epoch, popSize, pending, encodingVersion, manifestHash):
+        self.epoch = epoch                       #generation number
+        self.popSize = popSize                   #number of genomes in the generation
+        self.pending = pending                   #genomes that need evaluating (not known from the fitness cache)
+        self.encodingVersion = encodingVersion   #markov.GENOME_ENCODING_VERSION of the master
+        self.manifestHash = manifestHash         #hash of the list of genome hashes
+
+
+#Hash of a generation's list of genome hashes
+def manifest_hash(keys):
+    return hashlib.blake2b("\n".join(keys).encode('ascii'), digest_size = 8).hexdigest()
+
+
+#Interface shared by every backend. Genomes are passed around as markov.Genome objects, and
+#  every transport has a PollingPolicy in `polling` that paces the master's waits.
+class Transport:
+    #Master: write a new population for the slaves to evaluate. `known` optionally gives, per genome,
+    #  a (fitness, validation_fitness) pair already known from the fitness cache (or None); those
+    #  genomes are written as done and never handed to a slave.
+    def publish_population(self, genomes, known = None):
+        raise NotImplementedError
+
+    #Master: add genomes to the generation currently published, after the ones already in it. They
+    #  are claimed like any other genome of the generation. Returns the rows they were given.
+    def extend_population(self, genomes, known = None):
+        raise NotImplementedError
+
+    #Master, after a restart: take over the generation currently published if its first rows hold
+    #  `genomes`, in this order, so the evaluations already done (and in progress) carry on. Rows added
+    #  after them (e.g. prefetched genomes) are dropped, and the next extend_population writes over
+    #  them. Returns whether it did; if not, publish the generation again. Backends that don't outlive
+    #  the master never rejoin.
+    def rejoin(self, genomes):
+        return False
+
+    #Master: the (fitness, validation_fitness) of each of the given rows of the current generation,
+    #  or None for the rows without a result yet. Doesn't wait.
+    def read_results(self, rows):
+        raise NotImplementedError
+
+    #The Metadata of the generation currently published, or None if nothing was published yet
+    def read_metadata(self):
+        raise NotImplementedError
+
+    #Slave: try to claim up to `size` genomes nobody has claimed yet.
+    #  Returns (claim, genomes), or None if there is nothing to claim right now.
+    def claim_batch(self, size):
+        raise NotImplementedError
+
+    #Slave: renew the lease of a claim. Cheap to call often (e.g. between two evaluations):
+    #  the lease is only rewritten once a third of leaseTime has passed since the last renewal.
+    def heartbeat(self, claim):
+        raise NotImplementedError
+
+    #Slave: report the fitnesses for a claim returned by claim_batch. Genomes that already have
+    #  a result (another slave was faster on a re-dispatched claim) keep the first result, except
+    #  on SheetsTransport, where they keep the last one.
+    def submit_fitness(self, claim, fitnesses, validation_fitnesses):
+        raise NotImplementedError
+
+    #Master: block until the first popSize genomes of the generation have been evaluated, re-dispatching
+    #  stragglers near the end. Returns (fitnesses, validation_fitnesses) in population order.
+    #  Waits between polls follow the transport's PollingPolicy; `progress`, if given, is called with
+    #  the number of genomes done after every poll (e.g. to extend the generation as it nears its end).
+    def await_completion(self, popSize, progress = None):
+        raise NotImplementedError
+
+    #How many writes the master can make in a row before its request quota makes it wait, or None
+    #  if writes are free
+    def write_burst(self):
+        return None
+
+    #Release whatever the transport holds (connections, shared memory)
+    def close(self):
+        pass
+
+
+#Publishes a generation a few genomes at a time, as they are created: the first chunk publishes a
+#  new generation and the next ones extend it, so slaves can start on the first genomes while
+#  the rest are still being bred. Genomes already in the fitness cache are published as done.
+#  Call flush() once the last genome was added; `size` is then the size of the generation.
+#
+#Every chunk costs a write. Unless `chunkSize` is given, a generation of `total` genomes goes out in
+#  as many chunks as the transport can write without waiting on its quota, keeping one write for
+#  the prefetched genomes (see Transport.write_burst), or in chunks of STREAM_CHUNK if writes are free.
+STREAM_CHUNK = 50
+
+class PopulationStream:
+    def __init__(self, transport, cache, chunkSize = None, total = None):
+        self.transport = transport
+        self.cache = cache
+        if chunkSize is None:
+            burst = transport.write_burst()
+            if burst is None or total is None:
+                chunkSize = STREAM_CHUNK
+            else:
+                chunkSize = max(1, math.ceil(total / max(1, burst - 1)))
+        self.chunkSize = chunkSize
+        self.genomes = []
+        self.size = 0
+
+    def add(self, genome):
+        self.genomes.append(genome)
+        if len(self.genomes) >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if len(self.genomes) == 0:
+            return
+        known = [self.cache.get(genome.content_hash()) for genome in self.genomes]
+        if self.size == 0:
+            self.transport.publish_population(self.genomes, known)
+        else:
+            self.transport.extend_population(self.genomes, known)
+        self.size += len(self.genomes)
+        self.genomes = []
+
+
+#Column A starts with the metadata of the generation currently published: its epoch, population
+#  size, number of genomes pending evaluation, genome encoding version and manifest hash. Slaves
+#  poll this instead of the population. Every other cell the protocol writes is tagged
+#  "epoch:value", and a cell tagged with another epoch reads as empty.
+METADATA_RANGE = 'A1:A5'
+
+#Cell A6 holds a formula counting the results slaves wrote for the current epoch, so the master can
+#  poll a single cell to know how far the generation is. Rows published as done are left out: the
+#  master has their results, and keeps them even if a late slave writes over them (see submit_fitness).
+COUNTER_CELL = 'A6'
+COUNTER_FORMULA = '=COUNTIFS(E1:E50000, A1&":*", D1:D50000, "<>"&A1&":DONE")'
+
+#Cell A7 counts the genomes the master reopened in the current epoch ("epoch:count"), so slaves
+#  that found the generation drained know to look at it again.
+REOPENED_CELL = 'A7'
+
+#Column G holds the manifest of the generation: one "hash@row" entry per genome, pointing at
+#  the row of the genome store where the genome body lives.
+MANIFEST_COLUMN = 'G'
+
+#The genome store: column I holds the hash of a body and J onwards its encoded cells. A genome
+#  longer than one cell (markov.CELL_CHARACTER_LIMIT) continues into the next column, so J:N
+#  fits genomes of up to ~185,000 genes. Bodies are only ever appended, until STORE_ROWS is
+#  reached and the store is rewritten from the top with the live genomes.
+STORE_HASH_COLUMN = 'I'
+STORE_FIRST_COLUMN = 'J'
+STORE_LAST_COLUMN = 'N'
+STORE_ROWS = 50000
+STORE_WIDTH = ord(STORE_LAST_COLUMN) - ord(STORE_HASH_COLUMN) + 1   #cells of a store row, hash included
+
+#Characters a row of cells takes up in a request
+def _characters(row):
+    return sum(len(str(cell)) for cell in row if cell is not None)
+
+#Columns of a row as read from the range D:G
+FLAG, VALIDATION, FITNESS, MANIFEST = 0, 1, 2, 3
+
+
+#The original Google Sheets layout: column D holds claim flags (a "token|claimedAt|expiresAt"
+#  lease for a claimed genome, or "DONE" for genomes whose fitness was already known), E validation
+#  fitnesses, F fitnesses and G the manifest entry of each genome, one genome per row from row 1.
+#  Lease times are Unix times, so hosts should keep their clocks roughly in sync (well within leaseTime).
+#
+#Sheets has no compare-and-set, so a claim is written and then read back after claimSettle
+#  seconds: a slave only keeps the rows that still hold its own token. The wait gives a slave
+#  that read the same free rows just before us the time to overwrite them, so that we see it.
+#  To make two slaves going for the same rows unlikely in the first place, each slave picks a
+#  random batch among the free rows. In the rare case a write arrives after the other slave's
+#  read back, the batch is evaluated twice, which costs time but never loses a genome.
+#
+#Every claim costs three requests (a read of the flags, the lease and a read back that also fetches
+#  the bodies not cached yet) and every submission one, against quotas of 60 reads and 60 writes a
+#  minute shared by every process. Given the number of `slaves`, a claim takes at least
+#  1 / (slaves * claimsPerSlave) of the population, so a generation costs about as many requests
+#  whatever its size.
+#
+#Everything is laid out on the first tab of the spreadsheet, or on the tab named `tab`.
+#
+#Given `transferServices` (extra services, each with its own connection, see sheets_client.build_service),
+#  large transfers are split and sent concurrently, one request per service at a time. Every request
+#  costs a token of the ApiClient however much it carries, so a write is only split when it is too
+#  large for one request: the rows of a publication go out with the metadata in a single request
+#  if they come to at most requestCharacters, and in as few requests of up to requestCharacters each
+#  as they need otherwise (then the metadata that makes them visible goes last). Reads of more than
+#  chunkRows rows (the results of a large population) are split into chunkRows rows per request.
+#  A request that fails is retried alone by the ApiClient.
+class SheetsTransport(Transport):
+    def __init__(self, service, sheetID, client = None, polling = None, compress = False, cacheSize = 1000, workerID = None, claimSettle = 1.0,
+                 leaseTime = 300, speculateFraction = 0.1, drainedRecheck = 60, tab = None, transferServices = None, chunkRows = 10000,
+                 requestCharacters = 2000000, slaves = None, claimsPerSlave = 4):
+        self.service = service
+        self.values = service.spreadsheets().values()
+        self.chunkRows = chunkRows
+        self.requestCharacters = requestCharacters
+        self.transferValues = queue.Queue()    #values resources free for a chunk
+        self.transferPool = None
+        if transferServices:
+            for transferService in transferServices:
+                self.transferValues.put(transferService.spreadsheets().values())
+            self.transferPool = concurrent.futures.ThreadPoolExecutor(max_workers = len(transferServices))
+        self.sheetID = sheetID
+        self.tab = tab
+        self.claimSettle = claimSettle
+        self.leaseTime = leaseTime
+        self.speculateFraction = speculateFraction
+        self.speculated = set()              #master side: rows already re-dispatched this generation
+        self.workerID = workerID if workerID is not None else make_worker_id()
+        self.claimCounter = 0
+        self.compress = compress
+        self.client = client if client is not None else ApiClient()
+        self.polling = polling if polling is not None else PollingPolicy(2, 30)
+        self.counterWritten = False          #master side: whether COUNTER_CELL was set up by this process
+        self.cache = GenomeStore(cacheSize)  #slave side: bodies already downloaded
+        self.storeRows = None                #master side: hash -> store row of every uploaded body
+        self.nextStoreRow = 1
+        self.epoch = None                    #master side: epoch of the generation last published
+        self.keys = []                       #master side: hashes of the genomes published in this epoch
+        self.genomes = []                    #master side: and the genomes themselves
+        self.pending = 0                     #master side: how many of them need evaluating
+        self.known = {}                      #master side: row -> (fitness, validation_fitness) of the rows published as done
+        self.drainedEpoch = None             #slave side: last generation found with nothing to claim, when,
+        self.drainedAt = 0                   #  and the count of REOPENED_CELL then
+        self.drainedReopened = ""
+        self.popSizeSeen = 0                 #slave side: population size of the last generation seen
+        self.epochSeen = None                #slave side: epoch of the last generation seen
+        self.drainedRecheck = drainedRecheck   #how long a drained generation is left alone (expired leases reopen genomes)
+        self.slaves = slaves                 #slave side: how many slaves share the population, if known
+        self.claimsPerSlave = claimsPerSlave
+
+    #The ApiClient keeps retrying a request until it goes through; this assures the entire process
+    #  doesn't grind to a halt due to a temporary lost connection or a burst over the quota.
+    def _execute(self, request, write = False):
+        return self.client.execute(request, write)
+
+    #Every read and write goes through a RequestBatch, so the reads and writes of one step
+    #  cost one batchGet and one batchUpdate
+    def _batch(self):
+        return RequestBatch(self.values, self.sheetID, self._execute, tab = self.tab)
+
+    def _get(self, range_):
+        return self._batch_get([range_])[0]
+
+    def _batch_get(self, ranges):
+        with self._batch() as batch:
+            pending = [batch.get(range_) for range_ in ranges]
+        return [read.values for read in pending]
+
+    #Write several ranges in one request; the sheet applies them all at once
+    def _batch_update(self, data):
+        with self._batch() as batch:
+            for range_, values in data:
+                batch.update(range_, values)
+
+    #Split rows of values, to be written from row `first` of the columns firstColumn:lastColumn, into
+    #  chunks of at most requestCharacters (unless a single row is larger): a list of (range, values)
+    def _chunks(self, firstColumn, lastColumn, first, values):
+        chunks = []
+        start = 0
+        characters = 0
+        for x in range(len(values) + 1):
+            size = _characters(values[x]) if x < len(values) else 0
+            if x == len(values) or (x > start and characters + size > self.requestCharacters):
+                if x > start:
+                    chunks.append((firstColumn + str(first + start) + ":" + lastColumn + str(first + x - 1), values[start:x]))
+                start = x
+                characters = 0
+            characters += size
+        return chunks
+
+    #Run task(values) for every task on the transfer pool, each with a values resource of its own;
+    #  returns the results in order
+    def _transfer(self, tasks):
+        def run(task):
+            values = self.transferValues.get()
+            try:
+                return task(values)
+            finally:
+                self.transferValues.put(values)
+        futures = [self.transferPool.submit(run, task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def write_burst(self):
+        return int(self.client.writes.capacity)
+
+    def close(self):
+        if self.transferPool is not None:
+            self.transferPool.shutdown()
+
+    #Write chunks from _chunks, then `last` (a range and its values, written after everything else).
+    #  The chunks are packed into requests of up to requestCharacters; if there are transfer services
+    #  and it takes more than one, they are sent concurrently before `last`, otherwise everything goes
+    #  out in a single request.
+    def _chunked_update(self, data, last):
+        requests = []
+        characters = 0
+        for range_, values in data:
+            size = sum(_characters(row) for row in values)
+            if len(requests) == 0 or characters + size > self.requestCharacters:
+                requests.append([])
+                characters = 0
+            requests[-1].append((range_, values))
+            characters += size
+        if self.transferPool is None or len(requests) < 2:
+            self._batch_update(data + [last])
+            return
+        def task(request):
+            def send(resource):
+                with RequestBatch(resource, self.sheetID, self._execute, tab = self.tab) as batch:
+                    for range_, values in request:
+                        batch.update(range_, values)
+            return send
+        self._transfer([task(request) for request in requests])
+        self._batch_update([last])
+
+    #Rows first to last (1-based) of the columns firstColumn:lastColumn, read in chunks, concurrently if
+    #  there are transfer services. Like _get, the rows come back as the API gives them (trailing empty cells
+    #  and rows left out).
+    def _get_rows(self, firstColumn, lastColumn, first, last):
+        if self.transferPool is None or last - first + 1 <= self.chunkRows:
+            return self._get(firstColumn + str(first) + ":" + lastColumn + str(last)) or []
+        def task(start, end):
+            def read(resource):
+                with RequestBatch(resource, self.sheetID, self._execute, tab = self.tab) as batch:
+                    pending = batch.get(firstColumn + str(start) + ":" + lastColumn + str(end))
+                return pending.values or []
+            return read
+        starts = list(range(first, last + 1, self.chunkRows))
+        parts = self._transfer([task(start, min(start + self.chunkRows - 1, last)) for start in starts])
+        rows = []
+        for start, part in zip(starts, parts):
+            rows += [[] for x in range(start - first - len(rows))]   #empty rows the previous chunk left out
+            rows += part
+        return rows
+
+    def _store_range(self, first, last):
+        return STORE_HASH_COLUMN + str(first) + ":" + STORE_LAST_COLUMN + str(last)
+
+    #The value of the given column of row x if it is tagged with this epoch, or "" if it is empty or stale
+    def _value(self, rows, x, column, epoch):
+        if x < len(rows) and len(rows[x]) > column:
+            tag, sep, value = rows[x][column].partition(":")
+            if sep == ":" and tag == str(epoch):
+                return value
+        return ""
+
+    def _tag(self, epoch, value):
+        return str(epoch) + ":" + str(value)
+
+    def read_metadata(self):
+        return self._parse_metadata(self._get(METADATA_RANGE))
+
+    def _parse_metadata(self, rows):
+        if rows is None or len(rows) < 5 or any(len(row) == 0 for row in rows):
+            return None
+        return Metadata(int(rows[0][0]), int(rows[1][0]), int(rows[2][0]), int(rows[3][0]), rows[4][0])
+
+    def publish_population(self, genomes, known = None):
+        if self.epoch is None:
+            metadata = self.read_metadata()
+            self.epoch = metadata.epoch if metadata is not None else 0
+        self.epoch += 1
+        self.speculated = set()
+        self.keys = []
+        self.genomes = []
+        self.pending = 0
+        self.known = {}
+
+        #On the first publication of this master (we don't know what an earlier run left in the store)
+        #  or once the store is full, start the store over from the top with only the genomes of this
+        #  generation. Nothing is cleared: every store row is written to its full width, so a shorter body
+        #  leaves no cells of the one it replaces, and slaves check the hash of every body they read.
+        if self.storeRows is None or self.nextStoreRow + len(genomes) > STORE_ROWS + 1:
+            self.storeRows = {}
+            self.nextStoreRow = 1
+        self._publish_rows(genomes, known)
+
+    def extend_population(self, genomes, known = None):
+        first = len(self.keys)
+        self._publish_rows(genomes, known)
+        return list(range(first, len(self.keys)))
+
+    def rejoin(self, genomes):
+        keys = [genome.content_hash() for genome in genomes]
+        metadata = self.read_metadata()
+        if metadata is None or len(keys) == 0 or metadata.popSize < len(keys):
+            return False
+        #Find the store rows of the generation's bodies, so new bodies don't overwrite them, and the
+        #  results of the rows published as done
+        entries = self._get_rows('D', MANIFEST_COLUMN, 1, len(keys))
+        storeRows = {}
+        known = {}
+        lost = []
+        for x in range(len(keys)):
+            entry = self._value(entries, x, MANIFEST, metadata.epoch).split("@")
+            if len(entry) != 2 or entry[0] != keys[x]:
+                return False
+            storeRows[keys[x]] = int(entry[1])
+            if self._value(entries, x, FLAG, metadata.epoch) == "DONE":
+                if self._has_result(entries, x, metadata.epoch):
+                    known[x] = (float(self._value(entries, x, FITNESS, metadata.epoch)), float(self._value(entries, x, VALIDATION, metadata.epoch)))
+                else:   #written over by a late slave: evaluate it again
+                    lost.append(x)
+        self.epoch = metadata.epoch
+        self.speculated = set()
+        self.keys = keys
+        self.genomes = list(genomes)
+        self.pending = len(keys) - len(known)
+        self.known = known
+        self.storeRows = storeRows
+        self.nextStoreRow = max(storeRows.values()) + 1
+        #Rows published after the checkpoint are emptied (extending the generation again only writes
+        #  the manifest of the rows it adds, so their results would stick to the new genomes) and the
+        #  metadata is cut back to the checkpointed rows
+        with self._batch() as batch:
+            if len(lost) > 0:
+                self._write_rows("D", lost, ["" for x in lost], batch)
+            if metadata.popSize > len(keys):
+                batch.update('D' + str(len(keys) + 1) + ':' + MANIFEST_COLUMN + str(metadata.popSize), [["", "", "", ""] for x in range(len(keys), metadata.popSize)])
+            if len(lost) > 0 or metadata.popSize > len(keys):
+                batch.update(METADATA_RANGE, [[str(self.epoch)], [str(len(keys))], [str(self.pending)], [str(markov.GENOME_ENCODING_VERSION)], [manifest_hash(keys)]])
+        print('Generation {0} rejoined: {1} genomes.'.format(self.epoch, len(keys)))
+        return True
+
+    #Write the rows for `genomes` after the rows already published in this epoch, then the metadata
+    def _publish_rows(self, genomes, known):
+        keys = [genome.content_hash() for genome in genomes]
+        if known is None:
+            known = [None for key in keys]
+        first = len(self.keys)
+        data = []
+
+        #If the store fills up in the middle of a generation, start it over with the bodies of the whole
+        #  generation and point the rows already published at their new store rows. A slave reading
+        #  an old entry meanwhile finds another hash in the store and gives its claim back.
+        upload = list(zip(keys, genomes))
+        if self.nextStoreRow + len(genomes) > STORE_ROWS + 1 and first > 0:
+            self.storeRows = {}
+            self.nextStoreRow = 1
+            upload = list(zip(self.keys, self.genomes)) + upload
+
+        #Upload only the bodies the store has not seen
+        values = []
+        for key, genome in upload:
+            if key not in self.storeRows:
+                self.storeRows[key] = self.nextStoreRow + len(values)
+                cells = [key] + genome.encode_cells(self.compress)
+                values.append(cells + [""] * (STORE_WIDTH - len(cells)))
+        data += self._chunks(STORE_HASH_COLUMN, STORE_LAST_COLUMN, self.nextStoreRow, values)
+        self.nextStoreRow += len(values)
+        if len(upload) > len(genomes):
+            data += self._chunks(MANIFEST_COLUMN, MANIFEST_COLUMN, 1, [[self._tag(self.epoch, key + "@" + str(self.storeRows[key]))] for key in self.keys])
+
+        #The rows of the generation, with genomes of known fitness written as done (None leaves a cell
+        #  untouched; whatever an older generation left there reads as empty), then the new metadata
+        rows = []
+        for key, value in zip(keys, known):
+            entry = self._tag(self.epoch, key + "@" + str(self.storeRows[key]))
+            if value is None:
+                rows.append([None, None, None, entry])
+            else:
+                self.known[first + len(rows)] = value
+                rows.append([self._tag(self.epoch, "DONE"), self._tag(self.epoch, value[1]), self._tag(self.epoch, value[0]), entry])
+        data += self._chunks('D', MANIFEST_COLUMN, first + 1, rows)
+        self.keys += keys
+        self.genomes += genomes
+        self.pending += sum(1 for value in known if value is None)
+        metadata = (METADATA_RANGE, [[str(self.epoch)], [str(len(self.keys))], [str(self.pending)], [str(markov.GENOME_ENCODING_VERSION)], [manifest_hash(self.keys)]])
+        self._chunked_update(data, metadata)
+        print('Generation {0} {1}: {2} new genomes uploaded, {3} reused.'.format(self.epoch, "published" if first == 0 else "extended", len(values), len(keys) - len(values)))
+
+    #`cells`, if given, are the rows D:F from row min(rows) on, already read
+    def read_results(self, rows, cells = None):
+        if len(rows) == 0:
+            return []
+        if cells is None:
+            cells = self._get_rows('D', 'F', min(rows) + 1, max(rows) + 1)
+        results = []
+        for x in rows:
+            if x in self.known:
+                results.append(self.known[x])
+            elif self._has_result(cells, x - min(rows), self.epoch):
+                results.append((float(self._value(cells, x - min(rows), FITNESS, self.epoch)), float(self._value(cells, x - min(rows), VALIDATION, self.epoch))))
+            else:
+                results.append(None)
+        return results
+
+    #Write a value in the flag column of the given rows, leaving the rows in between untouched
+    def _write_flags(self, rows, value):
+        self._write_rows("D", rows, [value for x in rows])
+
+    #Lease cell of a claim: "epoch:token|claimedAt|expiresAt"
+    def _lease(self, epoch, token, claimedAt, now):
+        return self._tag(epoch, token + "|" + str(int(claimedAt)) + "|" + str(int(now + self.leaseTime)))
+
+    #Whether the genome at row x has its (validation) fitness written for this epoch
+    def _has_result(self, rows, x, epoch):
+        return any(char.isdigit() for char in self._value(rows, x, VALIDATION, epoch))
+
+    #A genome can be claimed if it has no result, and is unclaimed or its lease ran out
+    def _claimable(self, rows, x, epoch, now):
+        if self._has_result(rows, x, epoch):
+            return False
+        flag = self._value(rows, x, FLAG, epoch)
+        if flag == "":
+            return True
+        if flag == "DONE":
+            return False
+        parts = flag.split("|")
+        return len(parts) == 3 and float(parts[2]) < now
+
+    def claim_batch(self, size, attempts = 3):
+        #The metadata is all we read while polling a drained generation. Otherwise the claim flags and
+        #  results of the population (as large as last time) are read along with it.
+        polling = self.drainedEpoch is not None and time.time() - self.drainedAt < self.drainedRecheck
+        with self._batch() as batch:
+            metadataRead = batch.get(METADATA_RANGE)
+            reopenedRead = batch.get(REOPENED_CELL)
+            flagsRead = batch.get('D1:' + MANIFEST_COLUMN + str(self.popSizeSeen)) if self.popSizeSeen > 0 and not polling else None
+        metadata = self._parse_metadata(metadataRead.values)
+        if metadata is None or metadata.pending == 0:
+            return None
+        if metadata.encodingVersion != markov.GENOME_ENCODING_VERSION:
+            raise ValueError("The master publishes genome encoding version " + str(metadata.encodingVersion) + ", this process reads version " + str(markov.GENOME_ENCODING_VERSION))
+        epoch = metadata.epoch
+        self.epochSeen = epoch
+        reopened = self._value(reopenedRead.values or [], 0, 0, epoch)
+        #Unless the master extended the generation or reopened genomes since
+        if epoch == self.drainedEpoch and metadata.popSize == self.popSizeSeen and reopened == self.drainedReopened and polling:
+            return None
+
+        #Claims of a large population are sized so that each slave takes about claimsPerSlave of them
+        if self.slaves is not None:
+            size = max(size, -(-metadata.popSize // (self.slaves * self.claimsPerSlave)))
+
+        for attempt in range(attempts):
+            #The claim flags, results and manifest entries of the population are all we need (sheet rows are 1-based)
+            if attempt == 0 and flagsRead is not None and metadata.popSize <= self.popSizeSeen:
+                rows = flagsRead.values or []
+            else:
+                rows = self._get_rows('D', MANIFEST_COLUMN, 1, metadata.popSize)
+            self.popSizeSeen = metadata.popSize
+            now = time.time()
+
+            #Genomes of the current generation that are claimable
+            free = [x for x in range(metadata.popSize) if self._claimable(rows, x, epoch, now)]
+            if len(free) == 0:
+                self.drainedEpoch = epoch
+                self.drainedAt = now
+                self.drainedReopened = reopened
+                return None
+            batches = [free[x:x + size] for x in range(0, len(free), size)]
+            mine = random.choice(batches)
+            entries = dict((x, self._value(rows, x, MANIFEST, epoch)) for x in mine)
+            if any(len(entry.split("@")) != 2 for entry in entries.values()):   #the generation moved on while we were reading
+                return None
+
+            #Write our lease, then keep only the rows where it survived. The bodies we don't have yet
+            #  are read along with the flags, so the claim costs no request of its own for them.
+            first = mine[0]
+            token = self.workerID + "#" + str(self.claimCounter)
+            self.claimCounter += 1
+            self._write_flags(mine, self._lease(epoch, token, now, now))
+            time.sleep(self.claimSettle)
+            found = {}
+            missing = {}   #hash -> store row of the bodies to download
+            for x in mine:
+                key, row = entries[x].split("@")
+                if key in self.cache:
+                    found[key] = self.cache.get(key)
+                else:
+                    missing[key] = row
+            reads = self._batch_get(["D" + str(first + 1) + ":" + MANIFEST_COLUMN + str(mine[-1] + 1)]
+                                    + [self._store_range(int(row), int(row)) for row in missing.values()])
+            check = reads[0] or []
+            mine = [x for x in mine if self._value(check, x - first, FLAG, epoch).startswith(token + "|")]
+            if len(mine) > 0:
+                break
+        else:
+            return None
+
+        #The manifest entries must not have moved since we read them (the master started the store over)
+        if any(self._value(check, x - first, MANIFEST, epoch) != entries[x] for x in mine):
+            self._write_flags(mine, "")
+            return None
+        keys = [entries[x].split("@")[0] for x in mine]
+        for key, body in zip(missing, reads[1:]):
+            genome = None
+            if body is not None and len(body[0]) > 1 and body[0][0] == key:
+                try:
+                    genome = markov.Genome.decode_cells(body[0][1:])
+                except (ValueError, zlib.error):   #cells of two different bodies
+                    genome = None
+            if genome is None or genome.content_hash() != key:   #the store was rewritten under us; give the claim back
+                self._write_flags(mine, "")
+                return None
+            found[key] = genome
+            self.cache.put(genome, key)
+
+        return Claim(mine, token, now, epoch), [found[key] for key in keys]
+
+    def heartbeat(self, claim):
+        now = time.time()
+        if now - claim.renewedAt < self.leaseTime / 3.0:
+            return
+        #Only renew the rows that are still ours (the master may have re-dispatched some)
+        rows = claim.rows
+        check = self._get("D" + str(rows[0] + 1) + ":D" + str(rows[-1] + 1)) or []
+        mine = [x for x in rows if self._value(check, x - rows[0], FLAG, claim.epoch).startswith(claim.token + "|")]
+        if len(mine) > 0:
+            self._write_flags(mine, self._lease(claim.epoch, claim.token, claim.claimedAt, now))
+        claim.renewedAt = now
+
+    #Write one column of values for the given rows, leaving the rows in between untouched.
+    #  The write is queued on `batch` if one is given, and sent right away otherwise.
+    def _write_rows(self, column, rows, values, batch = None):
+        cells = [[None] for x in range(rows[-1] - rows[0] + 1)]
+        for index, value in zip(rows, values):
+            cells[index - rows[0]] = [value]
+        if batch is not None:
+            batch.update(column + str(rows[0] + 1) + ":" + column + str(rows[-1] + 1), cells)
+        else:
+            self._batch_update([(column + str(rows[0] + 1) + ":" + column + str(rows[-1] + 1), cells)])
+
+    def submit_fitness(self, claim, fitnesses, validation_fitnesses):
+        #Results are written without reading the rows first: they are tagged with the claim's epoch, so
+        #  the master ignores them once the generation has moved on. A genome evaluated twice (re-dispatched)
+        #  keeps the last result. Nothing is written once this slave has seen a newer generation; a slave
+        #  that hasn't may still overwrite results of the new generation, and the genomes are evaluated
+        #  again once their lease runs out (the master keeps the results of rows published as done itself).
+        if self.epochSeen is not None and self.epochSeen > claim.epoch:
+            return
+        rows = claim.rows
+        #Both columns go out in a single request
+        with self._batch() as batch:
+            self._write_rows("F", rows, [self._tag(claim.epoch, fitness) for fitness in fitnesses], batch)
+            self._write_rows("E", rows, [self._tag(claim.epoch, validation_fitness) for validation_fitness in validation_fitnesses], batch)
+
+    #Number of results of the current epoch according to the counter formula, or None if unavailable
+    def _read_done(self):
+        if not self.counterWritten:
+            #The formula has to be entered as a formula (not RAW), so it gets its own request, once
+            with RequestBatch(self.values, self.sheetID, self._execute, 'USER_ENTERED', self.tab) as batch:
+                batch.update(COUNTER_CELL, [[COUNTER_FORMULA]])
+            self.counterWritten = True
+        rows = self._get(COUNTER_CELL)
+        try:
+            return int(float(rows[0][0]))
+        except (TypeError, IndexError, ValueError):
+            return None
+
+    #One poll of await_completion: returns (done, results), where results is (fitnesses, validation_fitnesses)
+    #  once the first popSize genomes all have one, and None before that
+    def poll_completion(self, popSize):
+        if popSize == 0:
+            return 0, ([], [])
+        #Poll the result counter (which also counts rows past popSize, but not the rows published as
+        #  done); the flags and results are only read once the end is near
+        done = self._read_done()
+        if done is not None:
+            done += len(self.known)
+        if done is None or done >= popSize or popSize - done <= self.speculateFraction * popSize:
+            rows = self._get_rows('D', 'F', 1, popSize)
+            outstanding = [x for x in range(popSize) if x not in self.known and not self._has_result(rows, x, self.epoch)]
+            if len(outstanding) == 0:
+                results = self.read_results(range(popSize), rows)
+                return popSize, ([result[0] for result in results], [result[1] for result in results])
+            done = popSize - len(outstanding)
+
+            #Once every genome left is being worked on and only a few are left, reopen them (once each)
+            #  so idle slaves duplicate the stragglers
+            now = time.time()
+            if len(outstanding) <= self.speculateFraction * popSize and not any(self._claimable(rows, x, self.epoch, now) for x in outstanding):
+                reopen = [x for x in outstanding if x not in self.speculated]
+                if len(reopen) > 0:
+                    print("Re-dispatching " + str(len(reopen)) + " outstanding genomes.")
+                    self.speculated.update(reopen)
+                    #Drained slaves notice the new count on their next poll
+                    with self._batch() as batch:
+                        self._write_rows("D", reopen, ["" for x in reopen], batch)
+                        batch.update(REOPENED_CELL, [[self._tag(self.epoch, len(self.speculated))]])
+        return done, None
+
+    def await_completion(self, popSize, progress = None):
+        self.polling.reset()
+        lastDone = -1
+        while True:
+            done, results = self.poll_completion(popSize)
+            if results is not None:
+                return results
+            if progress is not None:
+                progress(done)
+            if done > lastDone:
+                self.polling.reset()
+                lastDone = done
+            self.polling.wait()
+
+
+#A population split across several SheetsTransports (shards), each on its own spreadsheet or tab,
+#  so no single sheet has to hold or serve the whole generation. The genomes the master publishes
+#  or adds are dealt out to the shards in turn, carrying on from one batch to the next, so the shards
+#  fill up evenly even when genomes come a few at a time (steady-state replacements, prefetched
+#  genomes); `rowMap` remembers where each row of the generation went, as (shard, row in the shard). Publishing, reading results and polling
+#  for completion send their requests to every shard at once, from one thread per shard (so each
+#  shard needs its own service; see sheets_client.build_service).
+#
+#A slave claims from its `home` shard, and once that one has nothing left, from the others in
+#  turn, unless `steal` is False.
+class ShardedTransport(Transport):
+    def __init__(self, shards, polling = None, home = 0, steal = True):
+        self.shards = shards
+        self.polling = polling if polling is not None else PollingPolicy(2, 30)
+        self.home = home % len(shards)
+        self.steal = steal
+        self.rowMap = []                     #master side: (shard, row in the shard) of every row of the generation
+        self.nextShard = 0                   #master side: shard the next genome goes to
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = len(shards))
+
+    #Run call(shard, argument) for every (index, argument) pair, in parallel; returns the results in order
+    def _each(self, calls):
+        futures = [self.pool.submit(call, self.shards[index], argument) for index, call, argument in calls]
+        return [future.result() for future in futures]
+
+    #Deal genomes (and their known values) out to the shards in turn: returns the run of genomes and
+    #  known values of every shard, and where each genome went, as (shard, position in the run)
+    def _spread(self, genomes, known):
+        if known is None:
+            known = [None for genome in genomes]
+        runs = [([], []) for shard in self.shards]
+        places = []
+        for genome, value in zip(genomes, known):
+            index = self.nextShard
+            self.nextShard = (self.nextShard + 1) % len(self.shards)
+            places.append((index, len(runs[index][0])))
+            runs[index][0].append(genome)
+            runs[index][1].append(value)
+        return runs, places
+
+    #Record the rows of the genomes, in order, given the first row of each shard's run
+    def _record(self, places, firsts):
+        rows = []
+        for index, x in places:
+            rows.append(len(self.rowMap))
+            self.rowMap.append((index, firsts[index] + x))
+        return rows
+
+    def publish_population(self, genomes, known = None):
+        runs, places = self._spread(genomes, known)
+        #Every shard starts a new generation, even those getting no genome from this first batch
+        self._each([(index, lambda shard, run: shard.publish_population(run[0], run[1]), run) for index, run in enumerate(runs)])
+        self.rowMap = []
+        self._record(places, [0 for run in runs])
+
+    def extend_population(self, genomes, known = None):
+        runs, places = self._spread(genomes, known)
+        calls = [(index, lambda shard, run: shard.extend_population(run[0], run[1]), run) for index, run in enumerate(runs) if len(run[0]) > 0]
+        added = self._each(calls)
+        firsts = [0 for run in runs]
+        for (index, call, run), rows in zip(calls, added):
+            firsts[index] = rows[0]
+        return self._record(places, firsts)
+
+    #The shard the generation's first genome went to isn't known after a restart, so every shard is
+    #  tried in turn as the first one; the generation is rejoined once every shard takes over its run
+    def rejoin(self, genomes):
+        if len(genomes) < len(self.shards):
+            return False
+        for start in range(len(self.shards)):
+            self.nextShard = start
+            runs, places = self._spread(genomes, None)
+            if all(self._each([(index, lambda shard, run: shard.rejoin(run[0]), run) for index, run in enumerate(runs)])):
+                self.rowMap = []
+                self._record(places, [0 for run in runs])
+                return True
+        self.nextShard = 0
+        return False
+
+    #Group rows of the generation by shard: shard -> list of (position in `rows`, row in the shard)
+    def _by_shard(self, rows):
+        groups = {}
+        for position, x in enumerate(rows):
+            index, row = self.rowMap[x]
+            groups.setdefault(index, []).append((position, row))
+        return groups
+
+    def read_results(self, rows):
+        results = [None for x in rows]
+        groups = self._by_shard(rows)
+        calls = [(index, lambda shard, group: shard.read_results([row for position, row in group]), group) for index, group in groups.items()]
+        for (index, call, group), read in zip(calls, self._each(calls)):
+            for (position, row), result in zip(group, read):
+                results[position] = result
+        return results
+
+    #The generation as a whole: the epoch of the first shard, with the sizes of all of them
+    def read_metadata(self):
+        found = self._each([(index, lambda shard, unused: shard.read_metadata(), None) for index in range(len(self.shards))])
+        if any(metadata is None for metadata in found):
+            return None
+        return Metadata(found[0].epoch, sum(metadata.popSize for metadata in found), sum(metadata.pending for metadata in found),
+                        found[0].encodingVersion, manifest_hash([metadata.manifestHash for metadata in found]))
+
+    #Claims are tagged with the shard they came from
+    def claim_batch(self, size):
+        order = [self.home]
+        if self.steal:
+            order += [(self.home + x) % len(self.shards) for x in range(1, len(self.shards))]
+        for index in order:
+            batch = self.shards[index].claim_batch(size)
+            if batch is not None:
+                batch[0].shard = index
+                return batch
+        return None
+
+    def heartbeat(self, claim):
+        self.shards[claim.shard].heartbeat(claim)
+
+    def submit_fitness(self, claim, fitnesses, validation_fitnesses):
+        self.shards[claim.shard].submit_fitness(claim, fitnesses, validation_fitnesses)
+
+    def await_completion(self, popSize, progress = None):
+        self.polling.reset()
+        lastDone = -1
+        #The first popSize rows of the generation are the first rows of every shard
+        sizes = [0 for shard in self.shards]
+        for index, row in self.rowMap[:popSize]:
+            sizes[index] = max(sizes[index], row + 1)
+        polls = [None for shard in self.shards]
+        while True:
+            #Shards already complete are not polled again
+            calls = [(index, lambda shard, size: shard.poll_completion(size), size) for index, size in enumerate(sizes)
+                     if polls[index] is None or polls[index][1] is None]
+            for (index, call, size), poll in zip(calls, self._each(calls)):
+                polls[index] = poll
+            done = sum(poll[0] for poll in polls)
+            if all(poll[1] is not None for poll in polls):
+                fitnesses = [polls[index][1][0][row] for index, row in self.rowMap[:popSize]]
+                validation_fitnesses = [polls[index][1][1][row] for index, row in self.rowMap[:popSize]]
+                return fitnesses, validation_fitnesses
+            if progress is not None:
+                progress(done)
+            if done > lastDone:
+                self.polling.reset()
+                lastDone = done
+            self.polling.wait()
+
+    #Every chunk is a write to each shard, and the shards of a master usually share one ApiClient
+    def write_burst(self):
+        bursts = [shard.write_burst() for shard in self.shards]
+        if any(burst is None for burst in bursts):
+            return None
+        return max(1, min(bursts) // len(self.shards))
+
+    def close(self):
+        self.pool.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+
+#Bumped whenever the tables of LocalTransport change; a file with another version is rebuilt
+LOCAL_SCHEMA_VERSION = 5
+
+
+#Same protocol kept in a single SQLite file. SQLite's locking makes the claim step a real
+#  transaction (the rows are selected and marked while holding the write lock), so any number
+#  of local processes can share the file safely. Like the sheet, the file holds a manifest of
+#  hashes per generation and a table of genome bodies. A generation is replaced in a single
+#  transaction, and every manifest row carries the epoch it belongs to, so a slave that reports
+#  late for an older generation can't write into the current one.
+class LocalTransport(Transport):
+    def __init__(self, path, polling = None, cacheSize = 1000, workerID = None, leaseTime = 300, speculateFraction = 0.1):
+        self.path = path
+        self.polling = polling if polling is not None else PollingPolicy(0.01, 1)
+        self.leaseTime = leaseTime
+        self.speculateFraction = speculateFraction
+        self.speculated = set()
+        self.claimCounter = 0
+        self.cache = GenomeStore(cacheSize)
+        self.workerID = workerID if workerID is not None else make_worker_id()
+        self.keys = []                       #master side: hashes of the genomes published in this epoch
+        self.db = sqlite3.connect(path, timeout = 60, isolation_level = None)
+        self.db.execute("BEGIN IMMEDIATE")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != LOCAL_SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS manifest")
+            self.db.execute("DROP TABLE IF EXISTS bodies")
+            self.db.execute("DROP TABLE IF EXISTS generation")
+            self.db.execute("PRAGMA user_version = " + str(LOCAL_SCHEMA_VERSION))
+        #claimed is 0 for free genomes, 1 once claimed by a slave (worker holds its claim token, expires
+        #  the end of its lease) and 2 for genomes published with a known fitness
+        self.db.execute("CREATE TABLE IF NOT EXISTS manifest (row INTEGER PRIMARY KEY, epoch INTEGER NOT NULL, hash TEXT NOT NULL, claimed INTEGER NOT NULL DEFAULT 0, worker TEXT, expires REAL, fitness REAL, validation REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, genome BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS generation (epoch INTEGER NOT NULL, popSize INTEGER, pending INTEGER, encodingVersion INTEGER, manifestHash TEXT)")
+        if self.db.execute("SELECT COUNT(*) FROM generation").fetchone()[0] == 0:
+            self.db.execute("INSERT INTO generation (epoch) VALUES (0)")
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+    def publish_population(self, genomes, known = None):
+        self.speculated = set()
+        self.keys = []
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("UPDATE generation SET epoch = epoch + 1, pending = 0")
+        self.epoch = self.db.execute("SELECT epoch FROM generation").fetchone()[0]
+        self.db.execute("DELETE FROM manifest")
+        self._insert_rows(genomes, known)
+        #Drop the bodies no longer in the population
+        self.db.execute("DELETE FROM bodies WHERE hash NOT IN (SELECT hash FROM manifest)")
+        self.db.execute("COMMIT")
+
+    def extend_population(self, genomes, known = None):
+        first = len(self.keys)
+        self.db.execute("BEGIN IMMEDIATE")
+        self._insert_rows(genomes, known)
+        self.db.execute("COMMIT")
+        return list(range(first, len(self.keys)))
+
+    def rejoin(self, genomes):
+        keys = [genome.content_hash() for genome in genomes]
+        metadata = self.read_metadata()
+        if metadata is None or len(keys) == 0 or metadata.popSize < len(keys):
+            return False
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            published = self.db.execute("SELECT hash FROM manifest WHERE epoch = ? AND row < ? ORDER BY row", (metadata.epoch, len(keys))).fetchall()
+            if [row[0] for row in published] != keys:
+                return False
+            #Drop the rows added after the checkpoint, so extending the generation again can insert its own
+            self.db.execute("DELETE FROM manifest WHERE row >= ?", (len(keys),))
+            pending = self.db.execute("SELECT COUNT(*) FROM manifest WHERE claimed != 2").fetchone()[0]
+            self.db.execute("UPDATE generation SET popSize = ?, pending = ?, manifestHash = ?", (len(keys), pending, manifest_hash(keys)))
+        finally:
+            self.db.execute("COMMIT")
+        self.epoch = metadata.epoch
+        self.speculated = set()
+        self.keys = keys
+        return True
+
+    #Add `genomes` after the rows already published in this epoch, and update the generation to match
+    def _insert_rows(self, genomes, known):
+        keys = [genome.content_hash() for genome in genomes]
+        if known is None:
+            known = [None for key in keys]
+        first = len(self.keys)
+        self.db.executemany("INSERT INTO manifest (row, epoch, hash, claimed, fitness, validation) VALUES (?, ?, ?, ?, ?, ?)",
+                            ((first + x, self.epoch, keys[x], 0, None, None) if known[x] is None else (first + x, self.epoch, keys[x], 2, known[x][0], known[x][1]) for x in range(len(keys))))
+        #Add the bodies the store has not seen
+        stored = set(row[0] for row in self.db.execute("SELECT hash FROM bodies"))
+        self.db.executemany("INSERT OR IGNORE INTO bodies (hash, genome) VALUES (?, ?)",
+                            ((key, genome.to_bytes()) for key, genome in zip(keys, genomes) if key not in stored))
+        self.keys += keys
+        self.db.execute("UPDATE generation SET popSize = ?, pending = pending + ?, encodingVersion = ?, manifestHash = ?",
+                        (len(self.keys), sum(1 for value in known if value is None), markov.GENOME_ENCODING_VERSION, manifest_hash(self.keys)))
+
+    def read_results(self, rows):
+        results = dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            "SELECT row, fitness, validation FROM manifest WHERE fitness IS NOT NULL AND validation IS NOT NULL AND row IN (" + ",".join("?" * len(rows)) + ")", rows))
+        return [results.get(x) for x in rows]
+
+    def read_metadata(self):
+        row = self.db.execute("SELECT epoch, popSize, pending, encodingVersion, manifestHash FROM generation").fetchone()
+        if row[1] is None:
+            return None
+        return Metadata(*row)
+
+    def claim_batch(self, size):
+        now = time.time()
+        token = self.workerID + "#" + str(self.claimCounter)
+        self.claimCounter += 1
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute("SELECT row, hash, epoch FROM manifest WHERE fitness IS NULL AND (claimed = 0 OR (claimed = 1 AND expires < ?)) ORDER BY row LIMIT ?",
+                                   (now, size)).fetchall()
+            if len(rows) == 0:
+                self.db.execute("COMMIT")
+                return None
+            self.db.executemany("UPDATE manifest SET claimed = 1, worker = ?, expires = ? WHERE row = ?",
+                                ((token, now + self.leaseTime, row[0]) for row in rows))
+            keys = [row[1] for row in rows]
+            missing = self.cache.missing(keys)
+            found = {}
+            if len(missing) > 0:
+                bodies = self.db.execute("SELECT hash, genome FROM bodies WHERE hash IN (" + ",".join("?" * len(missing)) + ")", missing).fetchall()
+                for key, data in bodies:
+                    found[key] = markov.Genome.from_bytes(data)
+                    self.cache.put(found[key], key)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        for key in keys:
+            if key not in found:
+                found[key] = self.cache.get(key)
+        return Claim([row[0] for row in rows], token, now, rows[0][2]), [found[key] for key in keys]
+
+    def heartbeat(self, claim):
+        now = time.time()
+        if now - claim.renewedAt < self.leaseTime / 3.0:
+            return
+        self.db.execute("UPDATE manifest SET expires = ? WHERE worker = ? AND claimed = 1", (now + self.leaseTime, claim.token))
+        claim.renewedAt = now
+
+    def submit_fitness(self, claim, fitnesses, validation_fitnesses):
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany("UPDATE manifest SET fitness = ?, validation = ? WHERE row = ? AND epoch = ? AND fitness IS NULL",
+                            ((fitnesses[x], validation_fitnesses[x], claim.rows[x], claim.epoch) for x in range(len(claim.rows))))
+        self.db.execute("COMMIT")
+
+    def await_completion(self, popSize, progress = None):
+        self.polling.reset()
+        lastDone = -1
+        while True:
+            done = self.db.execute("SELECT COUNT(*) FROM manifest WHERE fitness IS NOT NULL AND validation IS NOT NULL AND row < ?", (popSize,)).fetchone()[0]
+            if done >= popSize:
+                rows = self.db.execute("SELECT fitness, validation FROM manifest ORDER BY row LIMIT ?", (popSize,)).fetchall()
+                return [row[0] for row in rows], [row[1] for row in rows]
+
+            #Once every genome left is being worked on and only a few are left, reopen them (once each)
+            #  so idle slaves duplicate the stragglers
+            if popSize - done <= self.speculateFraction * popSize:
+                outstanding = [row[0] for row in self.db.execute("SELECT row FROM manifest WHERE (fitness IS NULL OR validation IS NULL) AND row < ?", (popSize,))]
+                claimable = self.db.execute("SELECT COUNT(*) FROM manifest WHERE fitness IS NULL AND (claimed = 0 OR (claimed = 1 AND expires < ?))",
+                                            (time.time(),)).fetchone()[0]
+                reopen = [x for x in outstanding if x not in self.speculated]
+                if claimable == 0 and len(reopen) > 0:
+                    print("Re-dispatching " + str(len(reopen)) + " outstanding genomes.")
+                    self.db.executemany("UPDATE manifest SET claimed = 0 WHERE row = ? AND fitness IS NULL", ((x,) for x in reopen))
+                    self.speculated.update(reopen)
+
+            if progress is not None:
+                progress(done)
+            if done > lastDone:
+                self.polling.reset()
+                lastDone = done
+            self.polling.wait()
+
+
+#Exclusive lock shared by unrelated processes on one host, held on a lock file
+class FileLock:
+    def __init__(self, path):
+        self.file = open(path, 'a+b')
+
+    def __enter__(self):
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    return self
+                except OSError:   #LK_LOCK gives up after 10 seconds
+                    pass
+        import fcntl
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if os.name == 'nt':
+            import msvcrt
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        return False
+
+    def close(self):
+        self.file.close()
+
+
+#Layout of the control block of SharedMemoryTransport: little-endian 64-bit integers at these offsets
+SHM_EPOCH, SHM_POP_SIZE, SHM_PENDING, SHM_ENCODING, SHM_NEXT_CLAIM, SHM_DONE, SHM_MANIFEST, SHM_NEXT_TOKEN, SHM_ARENA = range(0, 72, 8)
+SHM_CONTROL_SIZE = 72
+
+
+#A shared memory block opened by a process that did not create it. Before Python 3.13 the
+#  resource tracker unlinks every block a process opened when that process exits, which would
+#  pull the generation from under the master; only the creator should unlink it.
+def _attach_shared_memory(name):
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError:   #before Python 3.13
+        block = shared_memory.SharedMemory(name = name)
+    if os.name != 'nt':
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+#The population of one generation in a single shared memory block (the "arena"), laid out as
+#  offsets (int64, popSize + 1): where each genome starts in the genome bytes
+#  fitness, validation (float64, popSize each): NaN until the genome has a result
+#  expires (float64, popSize): 0 for a genome nobody holds, else the end of its lease
+#  tokens (int64, popSize): the claim holding each genome
+#  the genome bytes (uint8), one genome after the other
+class Arena:
+    def __init__(self, block, popSize):
+        self.block = block
+        self.popSize = popSize
+        view = memoryview(block.buf)
+        n = popSize
+        self.offsets = view[0 : 8 * (n + 1)].cast('q')
+        self.fitness = view[8 * (n + 1) : 8 * (2 * n + 1)].cast('d')
+        self.validation = view[8 * (2 * n + 1) : 8 * (3 * n + 1)].cast('d')
+        self.expires = view[8 * (3 * n + 1) : 8 * (4 * n + 1)].cast('d')
+        self.tokens = view[8 * (4 * n + 1) : 8 * (5 * n + 1)].cast('q')
+        self.data = view[8 * (5 * n + 1):]
+        self.views = [view, self.offsets, self.fitness, self.validation, self.expires, self.tokens, self.data]
+
+    @staticmethod
+    def size(popSize, dataSize):
+        return 8 * (5 * popSize + 1) + max(1, dataSize)
+
+    def has_result(self, x):
+        return not math.isnan(self.fitness[x])
+
+    #The genome bytes of row x, as a view into the arena (nothing is copied)
+    def genome_bytes(self, x):
+        return self.data[self.offsets[x] : self.offsets[x + 1]]
+
+    #Views into the block must be released before it can be closed
+    def close(self):
+        for view in reversed(self.views):
+            view.release()
+        self.block.close()
+
+
+#Every process on one host shares the generation through shared memory: a small control block
+#  named `name` holds the metadata and the claim counter, and the population lives in an arena
+#  block named "<name>_<n>", replaced by a new one for every new or extended generation. Slaves
+#  read genomes straight out of the arena and write fitnesses into it, so a generation changes
+#  hands without any copying or I/O.
+#  Updates go through a lock file next to the blocks; claiming is advancing the claim counter
+#  under the lock, and once the counter has passed the end of the population, claims pick up
+#  expired or reopened leases instead.
+#  The master creates the blocks and removes them on close() (or when it exits); call close()
+#  in slaves too.
+class SharedMemoryTransport(Transport):
+    def __init__(self, name, polling = None, leaseTime = 300, speculateFraction = 0.1):
+        import tempfile
+        self.name = name
+        self.polling = polling if polling is not None else PollingPolicy(0.001, 0.5)
+        self.leaseTime = leaseTime
+        self.speculateFraction = speculateFraction
+        self.speculated = set()
+        self.lock = FileLock(os.path.join(tempfile.gettempdir(), name + '.lock'))
+        self.control = None
+        self.owner = False       #whether this process created the blocks (the master)
+        self.arena = None
+        self.arenaNumber = None  #SHM_ARENA of the arena currently open
+        self.epoch = None
+        self.keys = []           #master side: hashes of the genomes published in this epoch
+
+    def _read(self, offset):
+        return struct.unpack_from('<q', self.control.buf, offset)[0]
+
+    def _write(self, offset, value):
+        struct.pack_into('<q', self.control.buf, offset, value)
+
+    #Slave: let go of the arena and the control block, e.g. once the master is gone
+    def _detach(self):
+        if self.arena is not None:
+            self.arena.close()
+            self.arena = None
+            self.arenaNumber = None
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+    #Slave: (re)open the control block; False if no master has created it yet
+    def _attach_control(self):
+        self._detach()
+        try:
+            self.control = _attach_shared_memory(self.name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    #Slave: the arena currently published, opened if needed (call with the lock held)
+    def _current_arena(self):
+        number = self._read(SHM_ARENA)
+        if number != self.arenaNumber:
+            if self.arena is not None:
+                self.arena.close()
+                self.arena = None
+                self.arenaNumber = None
+            try:
+                self.arena = Arena(_attach_shared_memory(self.name + "_" + str(number)), self._read(SHM_POP_SIZE))
+            except FileNotFoundError:
+                return None
+            self.arenaNumber = number
+        return self.arena
+
+    def close(self):
+        if self.arena is not None:
+            block = self.arena.block
+            self.arena.close()
+            if self.owner:
+                block.unlink()
+            self.arena = None
+        if self.control is not None:
+            if self.owner:
+                self._write(SHM_POP_SIZE, 0)   #tells attached slaves the master is gone
+            self.control.close()
+            if self.owner:
+                self.control.unlink()
+            self.control = None
+        self.lock.close()
+
+    def publish_population(self, genomes, known = None):
+        from multiprocessing import shared_memory
+        self.speculated = set()
+        if self.control is None:
+            try:
+                self.control = shared_memory.SharedMemory(name = self.name, create = True, size = SHM_CONTROL_SIZE)
+                self.control.buf[:SHM_CONTROL_SIZE] = bytes(SHM_CONTROL_SIZE)
+            except FileExistsError:   #left over from a master that didn't close it; take it over
+                self.control = shared_memory.SharedMemory(name = self.name)
+            self.owner = True
+        self.keys = []
+        self._publish_rows(genomes, known, True)
+
+    def extend_population(self, genomes, known = None):
+        first = len(self.keys)
+        self._publish_rows(genomes, known, False)
+        return list(range(first, len(self.keys)))
+
+    #Build a new arena holding the rows of the current arena (unless starting a new generation)
+    #  followed by `genomes`, and switch the control block over to it
+    def _publish_rows(self, genomes, known, newGeneration):
+        from multiprocessing import shared_memory
+        keys = [genome.content_hash() for genome in genomes]
+        if known is None:
+            known = [None for key in keys]
+        bodies = [genome.to_bytes() for genome in genomes]
+        old = None if newGeneration else self.arena
+        first = 0 if old is None else old.popSize
+        oldSize = 0 if old is None else old.offsets[first]
+        n = first + len(genomes)
+        number = self._read(SHM_ARENA) + 1
+        block = shared_memory.SharedMemory(name = self.name + "_" + str(number), create = True,
+                                           size = Arena.size(n, oldSize + sum(len(body) for body in bodies)))
+        arena = Arena(block, n)
+        offset = oldSize
+        for x in range(len(genomes)):
+            arena.offsets[first + x] = offset
+            arena.data[offset : offset + len(bodies[x])] = bodies[x]
+            offset += len(bodies[x])
+            if known[x] is None:
+                arena.fitness[first + x] = arena.validation[first + x] = float('nan')
+            else:
+                arena.fitness[first + x], arena.validation[first + x] = known[x]
+            arena.expires[first + x] = 0.0
+            arena.tokens[first + x] = -1
+        arena.offsets[n] = offset
+        pending = sum(1 for value in known if value is None)
+
+        with self.lock:
+            if old is not None:   #slaves only change the old arena under the lock, so copy it now
+                arena.offsets[:first] = old.offsets[:first]
+                arena.data[:oldSize] = old.data[:oldSize]
+                arena.fitness[:first] = old.fitness[:first]
+                arena.validation[:first] = old.validation[:first]
+                arena.expires[:first] = old.expires[:first]
+                arena.tokens[:first] = old.tokens[:first]
+                pending += self._read(SHM_PENDING)
+            else:
+                self.epoch = self._read(SHM_EPOCH) + 1
+                self._write(SHM_EPOCH, self.epoch)
+                self._write(SHM_NEXT_CLAIM, 0)
+                self._write(SHM_DONE, 0)
+            self.keys += keys
+            self._write(SHM_ARENA, number)
+            self._write(SHM_POP_SIZE, n)
+            self._write(SHM_PENDING, pending)
+            self._write(SHM_ENCODING, markov.GENOME_ENCODING_VERSION)
+            self._write(SHM_DONE, self._read(SHM_DONE) + len(genomes) - sum(1 for value in known if value is None))
+            struct.pack_into('<Q', self.control.buf, SHM_MANIFEST, int(manifest_hash(self.keys), 16))
+        #Slaves still reading the previous arena keep their mapping until they move on
+        if self.arena is not None:
+            previous = self.arena.block
+            self.arena.close()
+            previous.unlink()
+        self.arena = arena
+        self.arenaNumber = number
+
+    def read_metadata(self):
+        if self.control is None and not self._attach_control():
+            return None
+        if self._read(SHM_POP_SIZE) == 0:
+            return None
+        return Metadata(self._read(SHM_EPOCH), self._read(SHM_POP_SIZE), self._read(SHM_PENDING), self._read(SHM_ENCODING),
+                        format(struct.unpack_from('<Q', self.control.buf, SHM_MANIFEST)[0], '016x'))
+
+    def read_results(self, rows):
+        return [(self.arena.fitness[x], self.arena.validation[x]) if self.arena.has_result(x) else None for x in rows]
+
+    def claim_batch(self, size):
+        #A slave that finds nothing to claim reopens the control block, in case a new master replaced it
+        if self.control is None or self._read(SHM_POP_SIZE) == 0:
+            if not self._attach_control() or self._read(SHM_POP_SIZE) == 0:
+                return None
+        now = time.time()
+        rows = []
+        with self.lock:
+            arena = self._current_arena()
+            if arena is None:   #the master is gone; look for a new one next time
+                self._detach()
+                return None
+            epoch = self._read(SHM_EPOCH)
+            x = self._read(SHM_NEXT_CLAIM)
+            while x < arena.popSize and len(rows) < size:
+                if not arena.has_result(x) and arena.expires[x] == 0.0:
+                    rows.append(x)
+                x += 1
+            self._write(SHM_NEXT_CLAIM, x)
+            if len(rows) < size:   #the counter is past the end: take expired and reopened leases
+                for x in range(arena.popSize):
+                    if len(rows) >= size:
+                        break
+                    if not arena.has_result(x) and arena.expires[x] < now and x not in rows:
+                        rows.append(x)
+            if len(rows) == 0:
+                return None
+            token = self._read(SHM_NEXT_TOKEN)
+            self._write(SHM_NEXT_TOKEN, token + 1)
+            for x in rows:
+                arena.expires[x] = now + self.leaseTime
+                arena.tokens[x] = token
+
+            #The master may replace the arena as soon as we let go of the lock
+            genomes = []
+            for x in rows:
+                data = arena.genome_bytes(x)
+                genomes.append(markov.Genome.from_bytes(data))
+                data.release()
+        return Claim(rows, token, now, epoch), genomes
+
+    def heartbeat(self, claim):
+        now = time.time()
+        if now - claim.renewedAt < self.leaseTime / 3.0:
+            return
+        with self.lock:
+            if self.control is None:
+                return   #the master is gone
+            arena = self._current_arena()
+            if arena is not None and self._read(SHM_EPOCH) == claim.epoch:
+                for x in claim.rows:
+                    if arena.tokens[x] == claim.token and not arena.has_result(x):
+                        arena.expires[x] = now + self.leaseTime
+        claim.renewedAt = now
+
+    def submit_fitness(self, claim, fitnesses, validation_fitnesses):
+        with self.lock:
+            if self.control is None or self._read(SHM_EPOCH) != claim.epoch:
+                return   #late for an older generation
+            arena = self._current_arena()
+            if arena is None:
+                return
+            added = 0
+            for x in range(len(claim.rows)):
+                row = claim.rows[x]
+                if not arena.has_result(row):
+                    arena.validation[row] = validation_fitnesses[x]
+                    arena.fitness[row] = fitnesses[x]
+                    added += 1
+            self._write(SHM_DONE, self._read(SHM_DONE) + added)
+
+    def await_completion(self, popSize, progress = None):
+        self.polling.reset()
+        lastDone = -1
+        while True:
+            #The counter also counts rows past popSize, so check the rows themselves once it is high enough
+            done = self._read(SHM_DONE)
+            if done >= popSize:
+                done = sum(1 for x in range(popSize) if self.arena.has_result(x))
+                if done >= popSize:
+                    return list(self.arena.fitness[:popSize]), list(self.arena.validation[:popSize])
+
+            #Once every genome left is being worked on and only a few are left, reopen them (once each)
+            #  so idle slaves duplicate the stragglers
+            if popSize - done <= self.speculateFraction * popSize:
+                with self.lock:
+                    now = time.time()
+                    outstanding = [x for x in range(popSize) if not self.arena.has_result(x)]
+                    claimable = self._read(SHM_NEXT_CLAIM) < self.arena.popSize or any(self.arena.expires[x] < now for x in outstanding)
+                    reopen = [x for x in outstanding if x not in self.speculated]
+                    if not claimable and len(reopen) > 0:
+                        print("Re-dispatching " + str(len(reopen)) + " outstanding genomes.")
+                        for x in reopen:
+                            self.arena.expires[x] = 0.0
+                        self.speculated.update(reopen)
+
+            if progress is not None:
+                progress(done)
+            if done > lastDone:
+                self.polling.reset()
+                lastDone = done
+            self.polling.wait()